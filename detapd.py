@@ -10,19 +10,38 @@
 #
 # To do:
 # - Gracefull shut down when killed.
-# - Handle multiple messages per read from the socket.
 # - Add descriptive title to each of the entries in dict aps.
 #
+import bisect				# Binary search in sorted lists
+import collections			# Container data types
+import argparse				# Command line parsing
+import array				# Compact arrays of numbers
+import asyncio				# Event loop runtime
 import datetime
+import fcntl				# Size of socket backlog
+import gzip				# Compressed recordings
+import heapq				# Priority queue
 import math				# Goniometric functions
+import multiprocessing			# Parallel replay
+import os				# Operating system API
+import queue				# Queue between threads
 import re				# Regular expressions
+import selectors			# Wait for multiple sockets
 import signal
 import socket				# Socket API
+import struct				# Binary records
 import subprocess			# Start another process
 import sys				# System API
 import syslog
+import termios				# Size of socket backlog
 import threading
 import time
+import zlib				# Checksum of ICAO address, compression
+
+try:
+  import numpy				# Vectorised computations, optional
+except ImportError:
+  numpy= None
 
 
 #
@@ -37,6 +56,20 @@ import time
 RefPnt= dict( Latitude="Your", Longitude="Location" )	# Location, degrees
 Earth = 6364779				# Geocentric radius, [m]
 
+#
+# Optionally, the closest distance of each air plane is determined for a list of
+# additional reference points as well, for instance other houses, runway
+# thresholds or noise monitors. List RefPnts contains per point a dictionary
+# with its name, latitude and longitude. Per point, the distribution of the
+# closest distances is reported to Xymon in a test named after the point, and
+# the closest distance is appended as an extra column to the lines in PlaneLog,
+# in the order of this list. If module numpy is available and there are at least
+# PointsMin points, the distances to these points are computed using numpy.
+# For fewer points, the fixed overhead of numpy exceeds its gain.
+#
+RefPnts= []				# List of dict( Name=, Latitude=, Longitude= )
+PointsMin= 12				# Minimum number of points to use numpy
+
 #
 # Define the invocation parameters of the external data collector, dump1090. It
 # should publish only the BaseStation (decoded) messages and not generate any
@@ -51,6 +84,26 @@ ExtCol= [ '/path/to/dump1090/dump1090',
           '--net-bi-port', '0', '--net-bo-port', '0',
           '--quiet' ]
 
+#
+# Instead of the BaseStation messages, the raw Mode S messages can be read in
+# Beast binary format. The ADS-B messages are then decoded by this script,
+# restricted to the identification and the airborne position. In that case,
+# set Input to 'beast'. The data collector is then started with ExtColBeast,
+# which publishes only the Beast output on port BeastPort. Decoded positions
+# further than BeastRange [m] from the reference point are discarded.
+#
+Input= 'sbs'				# Input format, 'sbs' or 'beast'
+ExtColBeast= ExtCol[:1] + [
+          '--lat', str(RefPnt['Latitude'] ),
+          '--lon', str(RefPnt['Longitude']),
+          '--net', '--net-http-port', '0',
+          '--net-ri-port', '0', '--net-ro-port', '0',
+          '--net-bi-port', '0', '--net-sbs-port', '0',
+          '--net-bo-port', '30005',
+          '--quiet' ]
+BeastPort = 30005
+BeastRange= 450000			# Maximum range of receiver, [m]
+
 #
 # Program dump1090 exports the decoded messages on socket port TCP/30003. (Only
 # message type MSG will be available.)
@@ -59,19 +112,215 @@ ServerHost= 'localhost'
 ServerPort= 30003
 
 #
-# Define the distance classes to use. In this (ordered) list per distance class
-# a tuple, containing the name (key) as well as a part of the expression to
-# evaluate, is defined. The check for the correct class will evaluate the
-# classes in the order specified until one fits.
+# Optionally, the BaseStation messages of multiple receivers with overlapping
+# coverage can be combined. In that case list Feeds contains per receiver a
+# tuple with the host name and the port number. If the list is empty, only
+# ServerHost and ServerPort are used. The data collector is started only for the
+# first feed. A message which is received from another feed within DedupWindow
+# seconds, with the same contents, is discarded as a duplicate.
+#
+Feeds= []				# List of (host,port)
+DedupWindow= 2.0			# Duplicate detection window, [s]
+
+#
+# The connection to each feed is supervised. If the connection is closed by the
+# peer, or if no data is received during StallTime seconds, the connection is
+# rebuilt. Failed attempts are retried with an exponentially increasing
+# interval, from FeedBackoffMin up to FeedBackoffMax seconds. If the connection
+# to the first feed is refused, the data collector is (re)started, after which
+# its port is probed every ProbeInterval seconds until it accepts the
+# connection, during at most ReadyTimeout seconds. StallTime should exceed the
+# longest quiet period of the receiver, for instance at night.
+#
+StallTime     = 600			# Maximum time without data, [s]
+FeedBackoffMin= 1			# Minimum retry interval, [s]
+FeedBackoffMax= 300			# Maximum retry interval, [s]
+ProbeInterval = 0.5			# Interval of readiness probes, [s]
+ReadyTimeout  = 30			# Maximum start up time of collector, [s]
+ConnectTimeout= 5			# Timeout of one connection attempt, [s]
+
+#
+# Define the file to which a line is appended for each air plane which has
+# passed by and of which the distance is known.
+#
+PlaneLog= '/home/pi/air/plane.log'
+
+#
+# Define the file in which the state of this script, that is the statistics and
+# the air planes being tracked, is saved every SnapInterval seconds and when it
+# stops. At start up the state is restored from this file, if it exists, thus a
+# restart does not disturb the statistics. The file is written in a compact
+# binary format, and is replaced atomically. The distance rollups are appended
+# in compressed form, as most of their bins are empty. If Snapshot is None, the
+# state is not saved.
+#
+Snapshot    = '/home/pi/air/detapd.snap'	# State file
+SnapInterval= 60			# Interval between snapshots, [s]
+SnapVersion = 5				# Version of snapshot format
+SnapHeader= struct.Struct( '<4sHdddIII' )	# Magic, version, start of
+					# statistics, latitude and longitude of
+					# RefPnt, number of counters, air planes
+					# and additional reference points
+SnapPlane = struct.Struct( '<7s8sddII7d?' )	# ICAO address, call sign, first
+					# and last seen, message counts, current
+					# and previous location, distance and
+					# passed flag
+SnapRollup= struct.Struct( '<IIIdI' )	# Number of resolutions, rows per
+					# resolution, columns per row, width of
+					# distance bin and size of compressed
+					# rows
+
+#
+# Define the directory of the binary archive of passed air planes. Per day of
+# passing a segment file is created, containing a fixed-width record per air
+# plane, including those of which the distance is unknown. Each segment is
+# accompanied by an index file, containing per block of ArchiveBlock records
+# the minimum and maximum time of passing. Use script detapq.py to query the
+# archive. If ArchiveDir is None, no archive is made.
+#
+ArchiveDir  = '/home/pi/air/archive'	# Directory of archive
+ArchiveBlock= 256			# Records per index entry
+ArchiveRecord= struct.Struct( '<IIIIf8s' )	# First seen, last seen, ICAO
+					# address, location message count,
+					# distance and call sign
+ArchiveIndex = struct.Struct( '<II' )	# Minimum and maximum last seen
+
+#
+# Define the Xymon server and the handling of the status messages sent to it.
+# The status messages of one report cycle are combined into one combo message,
+# which is queued for a separate sender thread. If the Xymon server cannot be
+# reached, the combo message is saved in a spool file. A next message is merged
+# with the spooled one, keeping only the newest status of each test, thus the
+# spool file holds at most one message: Xymon stamps an RRD update with the time
+# of reception, thus a burst of old statuses would cause rejected updates or
+# spikes in the rates. As the counters are cumulative, the graphs show the
+# average rate over the outage instead. The retries are done with an
+# exponentially increasing interval. The resolved address of the server is
+# cached for XyDnsTtl seconds.
+#
+XymonHost= '127.0.0.1'			# Name / IP address of Xymon server
+XymonPort= 1984				# TCP port number of Xymon server
+XyQueueSize = 16			# Maximum number of queued messages
+XyTimeout   = 10			# Connect and send timeout, [s]
+XyBackoffMin= 5				# Minimum retry interval, [s]
+XyBackoffMax= 300			# Maximum retry interval, [s]
+XyDnsTtl    = 3600			# Lifetime of cached address, [s]
+XySpool     = '/home/pi/air/xymon.spool'	# Spool file
+
+#
+# Define the multi-resolution histograms of the closest distance, kept by the
+# script itself. Per resolution, in [s], a ring of RollupRows rows is kept,
+# covering the most recent RollupRows periods. Each row contains RollupBins
+# distance bins of RollupStep [m] wide, followed by a bin for larger distances
+# and a bin for unknown distances.
+#
+RollupRes = ( 300, 1800, 7200, 86400, 604800 )	# Resolutions, [s]
+RollupRows= 576				# Rows per resolution
+RollupStep= 250				# Width of distance bin, [m]
+RollupBins= 80				# Number of distance bins
+
+#
+# Besides to Xymon, the statistics can be exported to other sinks, each time the
+# Xymon reports are built. If PromFile is defined, the statistics are written to
+# that file in the Prometheus text exposition format, for instance for the
+# textfile collector of node_exporter. They are also available via command
+# 'prometheus' of the query socket. If StatsdHost is defined, the statistics are
+# sent to that StatsD server: the counters as increments since the previous
+# report and the number of air planes being tracked as gauges.
+#
+PromFile    = None			# Prometheus text file
+StatsdHost  = None			# Name / IP address of StatsD server
+StatsdPort  = 8125			# UDP port number of StatsD server
+StatsdPrefix= 'detapd'			# Prefix of metric names
+
+#
+# Define the Unix domain socket on which local queries are answered. A query
+# consists of one line with a command and its parameters. If QuerySocket is
+# None, no queries are answered.
+#
+QuerySocket= '/home/pi/air/detapd.sock'
+
+#
+# Define the socket on which the events of passing air planes are published,
+# either the path of a Unix domain socket or a tuple (host,port) of a TCP
+# socket. Each subscriber receives the events as lines of text. The events for
+# a subscriber are queued in a bounded queue: if it is full, events are dropped
+# rather than delaying the processing of messages. A subscriber which does not
+# accept data for EventTimeout seconds is disconnected. If EventSocket is None,
+# no events are published.
+#
+EventSocket = None			# Path or (host,port)
+EventQueue  = 256			# Capacity of queue per subscriber
+EventClients= 8				# Maximum number of subscribers
+EventTimeout= 30			# Send timeout, [s]
+
+#
+# Define the interval between two samples of the sampling profiler, which can be
+# started and stopped using a query, and the number of functions reported.
+#
+ProfInterval= 0.005			# Sampling interval, [s]
+ProfTop     = 25			# Number of functions in report
+
+#
+# Define the number of octets to read from the socket in one go and the maximum
+# length of one BaseStation message. A message which does not fit in the latter
+# is discarded.
+#
+ReadSize= 4096				# Octets per read from socket
+MaxLine = 512				# Maximum length of a message
+
+#
+# The messages read from the sockets are passed to a separate processing thread
+# via a ring buffer, which holds at most RingSize messages. If it is full, the
+# messages just read are dropped. Errors in the message stream are logged at
+# most once per LogInterval seconds per kind of error; the number of
+# suppressed errors is logged at the end of the interval.
+#
+RingSize   = 16384			# Capacity of ring buffer, [messages]
+LogInterval= 60				# Interval of error logging, [s]
+
+#
+# Define the time after which an air plane is considered to have gone, if no
+# message is received from it anymore.
+#
+PlaneTimeout= 120			# Expiry time of an air plane, [s]
+
+#
+# An ICAO address is only entered in the air plane list once AdmitCount
+# messages are received from it within AdmitWindow seconds. Until then, its
+# messages are held on probation. A bit error in a decoded address thus does not
+# create an air plane. The air plane list contains at most MaxPlanes air planes.
+# If it is full, the air plane seen least recently is evicted. If AdmitCount is
+# 1, every address is entered immediately.
+#
+AdmitCount = 2				# Messages needed to admit an address
+AdmitWindow= 10				# Admission window, [s]
+MaxPlanes  = 2000			# Maximum size of air plane list
+
+#
+# Define the minimum number of position messages in one batch, read from the
+# socket in one go or from a recording in one second, to compute the distances
+# using numpy. Smaller batches are handled one message at a time, as that is
+# faster for up to about a hundred messages.
+#
+BatchMin= 128				# Minimum size of vectorised batch
+
+#
+# Define the distance classes to use. In this list per distance class a tuple is
+# defined, containing the name (key), the upper bound of the class in [m] and
+# the name of the RRD data set. A distance d falls in the first class for which
+# d < upper bound. The bounds must be increasing and the last one must be
+# infinite. The class with upper bound None collects the air planes of which
+# the distance is unknown. The table may contain any number of classes.
 #
 DistClass= [
-  ( 'dist_unknown'  , 'is None' ),
-  ( 'dist_00_01_km' , '<  1000' ),
-  ( 'dist_01_02_km' , '<  2000' ),
-  ( 'dist_02_04_km' , '<  4000' ),
-  ( 'dist_04_08_km' , '<  8000' ),
-  ( 'dist_08_16_km' , '< 16000' ),
-  ( 'dist_16_inf_km', '>=16000' )
+  ( 'dist_unknown'  ,  None   , 'dunkn' ),
+  ( 'dist_00_01_km' ,  1000   , 'd0001' ),
+  ( 'dist_01_02_km' ,  2000   , 'd0102' ),
+  ( 'dist_02_04_km' ,  4000   , 'd0204' ),
+  ( 'dist_04_08_km' ,  8000   , 'd0408' ),
+  ( 'dist_08_16_km' , 16000   , 'd0816' ),
+  ( 'dist_16_inf_km', math.inf, 'd1600' )
 ]
 
 #
@@ -81,17 +330,31 @@ DistClass= [
 sosts= None				# Start-of-script time stamp
 sosrf= None				#  in human readable form
 
+DistKeys = []				# Keys of the distance classes, ordered
+DistEdges= []				# Upper bounds of these classes, except last
+DistUnkn = None				# Key of class 'distance unknown'
+HourCache= {}				# Unix time per date and hour
+
+RefCart= []				# Cartesian coordinates of RefPnts
+RefVect= False				#  flag: RefCart is a numpy array
+RefRel = None				#  relative to RefPnt, if numpy is available
+RefRR  = None				#  and their squared norms
+
+Origin = (0.0,0.0,0.0)			# Cartesian coordinates of RefPnt
+RefReach= 0				# Largest distance of RefPnts to RefPnt, [m]
+
 apl= {}					# Air plane list
-ams= dict(				# ADS-B message statistics
-  total_messages= 0,			# Total number of messages received
-  procd_messages= 0,			# Number of processed messages
-  zero_id_messages= 0,			# Number of messages with a null ICAO address
-  erred_messages= 0,			# Number of erred messages received
-)
-aps= dict(				# Air plane statistics
-  total_airplane= 0,			# Total number of airplanes detected
-)
-for i in DistClass:  aps[i[0]]= 0	# Add counter per distance class
+apx= None				# Expiry index of air plane list
+apa= None				# Admission filter of air plane list
+apv= collections.deque()		# Evicted air planes, not yet recorded
+adr= None				# Distance rollups
+aev= None				# Publisher of pass events, if any
+afs= {}					# ADS-B statistics per feed
+app= {}					# Air plane statistics per point in RefPnts
+#
+# Counters ams and aps and hot path metrics amx are allocated after the
+# definitions of classes Counters and Histogram.
+#
 
 #
 # Utilities.
@@ -112,17 +375,90 @@ def Cartesian( lat, long, alt ):
   z= ra*math.sin(la)
   return (x,y,z)
 
+#
+# Function SegmentBound returns a lower bound of the distance of RefPnt to the
+# flight path from p to q, in cartesian coordinates: the distance to the
+# bounding box of p and q. As both the point of closest approach and q lie in
+# this box, neither is closer by. If the bound is not less than the distance
+# found so far, the flight path cannot improve on it.
+#
+def SegmentBound( p, q ):
+  x,y,z= Origin
+  lo,hi= (p[0],q[0]) if p[0] < q[0] else (q[0],p[0])
+  dx= lo - x if x < lo else x - hi if x > hi else 0.0
+  lo,hi= (p[1],q[1]) if p[1] < q[1] else (q[1],p[1])
+  dy= lo - y if y < lo else y - hi if y > hi else 0.0
+  lo,hi= (p[2],q[2]) if p[2] < q[2] else (q[2],p[2])
+  dz= lo - z if z < lo else z - hi if z > hi else 0.0
+  return math.sqrt( dx*dx + dy*dy + dz*dz )
+
+#
+# Function Cartesians is the vectorised version of function Cartesian, using
+# numpy. It takes arrays of latitudes and longitudes, in degrees, and altitudes,
+# in [ft], and returns an N x 3 array of cartesian coordinates.
+#
+def Cartesians( lats, longs, alts ):
+  ra= Earth + alts*0.3048
+  la= numpy.radians( lats ) ;  lo= numpy.radians( longs )
+  ca= ra*numpy.cos(la)
+  q = numpy.empty( (len(ra),3) )
+  q[:,0]= ca*numpy.cos(lo)
+  q[:,1]= ca*numpy.sin(lo)
+  q[:,2]= ra*numpy.sin(la)
+  return q
+
+#
+# Function CompileDistClass converts the table of distance classes into a list
+# of keys, sorted on distance, and a list of class boundaries, such that the
+# class of a distance can be found using a binary search. It needs to be invoked
+# once, before any distance is classified.
+#
+def CompileDistClass( table ):
+  global DistKeys, DistEdges, DistUnkn
+  keys= [] ;  edges= [] ;  unkn= None
+  for (key,bound,ds) in table:
+    if bound is None:
+      unkn= key
+      continue
+    if edges and bound <= edges[-1]:
+      raise ValueError( 'Distance classes are not increasing at {}'.format(key) )
+    keys.append( key )
+    edges.append( bound )
+  if unkn is None  or  not edges  or  edges[-1] != math.inf:
+    raise ValueError( 'Distance classes need an unknown and an infinite class' )
+  DistKeys = keys
+  DistEdges= edges[:-1]			# Last bound is infinite
+  DistUnkn = unkn
+
 #
 # Function ClassifyDistance maps the distance, expressed in [m], onto a key to
 # be used in a dictionary. Per distance class one such a key is defined.
 #
 def ClassifyDistance( d ):
-  for i in DistClass:			# Get next distance class tuple
-    expr= 'd {}'.format( i[1] )		# Build expression to evaluate
-    if eval( expr):
-      key= i[0]
-      break
-  return key
+  if d is None:  return DistUnkn
+  return DistKeys[bisect.bisect_right( DistEdges, d )]
+
+#
+# Function CountDistances classifies a sequence of distances, expressed in [m],
+# and returns the number of distances per class in a dictionary. A distance
+# which is unknown is either None or NaN. If module numpy is available, all
+# distances are classified in one vectorised operation.
+#
+def CountDistances( ds ):
+  cnt= dict.fromkeys( DistKeys, 0 )
+  cnt[DistUnkn]= 0
+  if numpy is not None:
+    a= numpy.array( ds, dtype=float )	# None is converted to NaN
+    known= a[~numpy.isnan(a)]
+    cnt[DistUnkn]= len(a) - len(known)
+    idx= numpy.searchsorted( DistEdges, known, side='right' )
+    for i,n in enumerate( numpy.bincount(idx,minlength=len(DistKeys)) ):
+      cnt[DistKeys[i]]= int(n)
+  else:
+    for d in ds:
+      if d != d:  d= None		# NaN is an unknown distance
+      cnt[ClassifyDistance(d)]+= 1
+  return cnt
 
 #
 # Function Distance computes the distance between two points, specified in
@@ -132,6 +468,153 @@ def Distance( a, b ):
   d= (a[0]-b[0])**2 + (a[1]-b[1])**2 + (a[2]-b[2])**2
   return math.sqrt( d )
 
+#
+# Function SegmentDistance computes the distance of point r to the flight path
+# from p to q, all in cartesian coordinates. If the point of closest approach on
+# the straight line through p and q is in between p and q, the distance to that
+# point is returned, otherwise the distance to q. If p is None, it is the
+# distance from r to q.
+#
+def SegmentDistance( p, q, r ):
+  if p is None:  return Distance( q, r )
+  snum= 0 ;  sden= 0
+  for i in range(3):
+    snum+= (q[i] - p[i])*(r[i] - p[i])
+    sden+= (q[i] - p[i])**2
+  s= snum / sden
+  if 0.0 <= s <= 1.0:
+    return Distance( [ p[i] + s*(q[i] - p[i]) for i in range(3) ], r )
+  return Distance( q, r )
+
+#
+# Function PointDistances computes the distance of each of the points in
+# RefPnts to the flight path from p to q, as defined for SegmentDistance. If
+# RefVect is set, the distances are computed in one vectorised operation.
+#
+def PointDistances( p, q ):
+  if not RefVect:
+    return [ SegmentDistance( p, q, r ) for r in RefCart ]
+  r= RefCart ;  q= numpy.asarray( q )
+  if p is None:
+    t= q[None,:]
+  else:
+    p= numpy.asarray( p ) ;  d= q - p
+    s= ( (r - p) @ d ) / ( d @ d )
+    hit= (s >= 0.0) & (s <= 1.0)
+    t= numpy.where( hit[:,None], p + s[:,None]*d, q )
+  return numpy.sqrt( numpy.einsum( 'ij,ij->i', t - r, t - r ) )
+
+#
+# Function MaxDistance returns the largest distance in sequence a.
+#
+def MaxDistance( a ):
+  return float( a.max() ) if RefVect else max( a )
+
+#
+# Function MinDistances returns the element-wise minimum of two sequences of
+# distances, of which the first one may be None.
+#
+def MinDistances( a, b ):
+  if a is None:  return b
+  if RefVect:  return numpy.minimum( a, b )
+  return [ min(x,y) for x,y in zip(a,b) ]
+
+#
+# Function CprNL returns the number of longitude zones of the CPR encoding at
+# latitude lat, as defined in the ADS-B specification. The latitudes at which
+# the number of zones changes are computed once.
+#
+CprNZ= 15				# Number of latitude zones per quadrant
+CprNLTable= [ math.degrees( math.acos( math.sqrt(
+                (1 - math.cos(math.pi/(2*CprNZ))) / (1 - math.cos(2*math.pi/nl)) ) ) )
+              for nl in range(59,1,-1) ]	# Transition latitudes, increasing
+
+def CprNL( lat ):
+  return 59 - bisect.bisect_left( CprNLTable, abs(lat) )
+
+#
+# Function CprLocal decodes one CPR encoded position, of format odd (0 = even,
+# 1 = odd), relative to the reference position (rlat,rlon). The result is
+# correct if the actual position is within 180 NM of the reference position.
+#
+def CprLocal( odd, latc, lonc, rlat, rlon ):
+  dlat= 360.0 / ( 4*CprNZ - odd )
+  j  = math.floor( rlat/dlat ) + math.floor( (rlat % dlat)/dlat - latc/131072 + 0.5 )
+  lat= dlat*( j + latc/131072 )
+  dlon= 360.0 / max( CprNL(lat) - odd, 1 )
+  m  = math.floor( rlon/dlon ) + math.floor( (rlon % dlon)/dlon - lonc/131072 + 0.5 )
+  lon= dlon*( m + lonc/131072 )
+  return (lat,lon)
+
+#
+# Function CprGlobal decodes a pair of CPR encoded positions, an even one and an
+# odd one, each given as a tuple (lat,lon), into a position without ambiguity.
+# The most recent one, indicated by odd, determines the resulting position.
+# None is returned if the two positions are in different longitude zones.
+#
+def CprGlobal( even, oddp, odd ):
+  dlat0= 360.0 / ( 4*CprNZ )
+  dlat1= 360.0 / ( 4*CprNZ - 1 )
+  j= math.floor( (59*even[0] - 60*oddp[0])/131072 + 0.5 )
+  lat0= dlat0*( j % 60 + even[0]/131072 )
+  lat1= dlat1*( j % 59 + oddp[0]/131072 )
+  if lat0 >= 270:  lat0-= 360
+  if lat1 >= 270:  lat1-= 360
+  nl= CprNL( lat0 )
+  if nl != CprNL( lat1 ):  return None
+  lat= lat1 if odd else lat0
+  ni = max( nl - odd, 1 )
+  m  = math.floor( (even[1]*(nl-1) - oddp[1]*nl)/131072 + 0.5 )
+  lon= (360.0/ni)*( m % ni + (oddp[1] if odd else even[1])/131072 )
+  if lon >= 180:  lon-= 360
+  return (lat,lon)
+
+#
+# Function ParseSbs checks the shape of BaseStation message line and returns a
+# tuple, starting with the ICAO address and the transmission type, in the same
+# format as the result of ModeSDecoder.Decode. Only the fields relevant to this
+# script are converted: the call sign of type 1 and the position of type 3. The
+# other transmission types are reduced to (id,0). ValueError is raised if the
+# line is malformed. The line is split into all of its fields at once, which is
+# as fast as splitting off only the fields needed.
+#
+SbsTypes= { '1': 1, '2': 0, '3': 3, '4': 0, '5': 0, '6': 0, '7': 0, '8': 0 }
+
+def ParseSbs( line ):
+  flds= line.split( ',' )
+  if len(flds) != 22:
+    raise ValueError( 'Unexpected number of fields in "{}"'.format(line) )
+  if flds[0] != 'MSG':
+    raise ValueError( 'Unexpected message type received: "{}"'.format(flds[0]) )
+  id= flds[4]				# ICAO airplane address
+  tt= SbsTypes.get( flds[1] )		# Transmission type
+  if tt == 0  or  id == '000000':
+    return (id,0)
+  if tt == 3:
+    try:
+      return (id,3,float(flds[14]),float(flds[15]),int(flds[11]))
+    except ValueError:
+      raise ValueError( 'Unexpected position in "{}"'.format(line) ) from None
+  if tt == 1:
+    return (id,1,flds[10])
+  raise ValueError( 'Unexpected MSG transmission type received: {}'.format(flds[1]) )
+
+#
+# Function DecodeDateTime converts the date and the time of day, as found in a
+# BaseStation message in the format 'YYYY/MM/DD' and 'HH:MM:SS.sss', into a
+# Unix time stamp, using the local time zone. The conversion of the date and
+# the hour is cached. Exception ValueError is raised if the format is wrong.
+#
+def DecodeDateTime( date, tod ):
+  hms= tod.split( ':' )
+  if len(hms) != 3:  raise ValueError( 'Invalid time of day' )
+  key= (date,hms[0])
+  uts= HourCache.get( key )
+  if uts is None:
+    dt = datetime.datetime.strptime( date + ' ' + hms[0], '%Y/%m/%d %H' )
+    uts= HourCache[key]= time.mktime( dt.timetuple() )
+  return uts + int(hms[1])*60 + float(hms[2])
+
 #
 # Function EncodeDateTime returns a human readable version of the time stamp,
 # using ISO8601 format.
@@ -154,12 +637,17 @@ class StoppableThread(threading.Thread):
   """Thread class with a stop() method. The thread itself has to check regularly
   for the stopped() condition."""
 
+  SysLog= True				# Log to syslog, otherwise to stderr
+
   def __init__( self ):
     super().__init__()
     self._stop_event = threading.Event()
+    self._errors= {}			# Per kind of error: start of interval and
+					# number of suppressed errors
+    self._errlock= threading.Lock()	# Serialise access to _errors
  #
-    self.XyServ= '127.0.0.1' 		# Name / IP address of Xymon server
-    self.XyPort= 1984			# TCP port number of Xymon server
+    self.XyServ= XymonHost 		# Name / IP address of Xymon server
+    self.XyPort= XymonPort		# TCP port number of Xymon server
 
   def stop( self ):
     self._stop_event.set()
@@ -185,41 +673,54 @@ class StoppableThread(threading.Thread):
     return result
 
  #
- # Method InformXymon sends a status message to the Xymon server.
+ # Method FormatXymon builds a status message for the Xymon server.
  #
-  def InformXymon( self, Hst, Tst, Clr, Msg ):
+  def FormatXymon( self, Hst, Tst, Clr, Msg ):
     XyTime= int( time.time() )
     XyTime= datetime.datetime.fromtimestamp(XyTime).isoformat( sep=' ' )
     XyPars= { 'host': Hst, 'test': Tst, 'colour': Clr, 'time': XyTime,
               'message': Msg }
-    XyMsg = '''status {host}.{test} {colour} {time}
+    return '''status {host}.{test} {colour} {time}
 {message}'''.format( **XyPars )
-    try:
-      s= socket.socket( socket.AF_INET, socket.SOCK_STREAM )
-    except socket.error as msg:
-      return False
-    if not re.search( '^[\d\.]+$', self.XyServ ):
-      try:
-        self.XyServ= socket.gethostbyname( self.XyServ )
-      except socket.gaierror:
-        return False
-    try:
-      s.connect( (self.XyServ, self.XyPort) )
-      s.sendall( XyMsg.encode() )
-      return True
-    except socket.error as msg:
-      return False
-    finally:
-      s.close()
 
  #
  # Method LogMessage sends a message to the local syslog server.
  #
   def LogMessage( self, Msg ):
+    if not self.SysLog:
+      print( self.name, Msg, file=sys.stderr )
+      return
     syslog.openlog( 'APD', 0, syslog.LOG_LOCAL6 )
     syslog.syslog ( ' '.join( (self.name,Msg) ) )
     syslog.closelog()
 
+ #
+ # Method LogError logs an error of kind Kind, which may occur at a high rate.
+ # Only the first error of each kind within an interval of LogInterval seconds
+ # is logged. The others are counted, and their number is logged by method
+ # FlushErrors at the end of the interval. As the methods of one thread object
+ # may be invoked by another thread, the administration is protected by a lock.
+ #
+  def LogError( self, Kind, Msg ):
+    now= time.time()
+    with self._errlock:
+      ent= self._errors.get( Kind )
+      if ent is not None  and  now < ent[0] + LogInterval:
+        ent[1]+= 1
+        return
+      if ent is not None  and  ent[1] > 0:
+        self.LogMessage( '{} more error(s) of kind {} suppressed'.format(ent[1],Kind) )
+      self._errors[Kind]= [now,0]
+    self.LogMessage( Msg )
+
+  def FlushErrors( self ):
+    now= time.time()
+    with self._errlock:
+      for Kind in [ k for k,v in self._errors.items() if now >= v[0] + LogInterval ]:
+        if self._errors[Kind][1] > 0:
+          self.LogMessage( '{} more error(s) of kind {} suppressed'.format(self._errors[Kind][1],Kind) )
+        del self._errors[Kind]
+
  #
  # Method Wait waits until the (Unix) timestamp reaches the next integer
  # multiple of Period seconds and then another Delay seconds. However, if the
@@ -229,335 +730,2222 @@ class StoppableThread(threading.Thread):
  # 0 <= Delay < Period.
  #
   def Wait( self, Period, Delay ):
+    self.wait( self.WaitTime( Period, Delay ) )
+
+ #
+ # Method WaitTime returns the number of seconds method Wait would wait.
+ #
+  def WaitTime( self, Period, Delay ):
     Now= time.time()
     ActTim= int( Now )
     ActTim= ( (ActTim+Period-1) // Period ) * Period
     SlpTim= int( ActTim - Now ) + Delay
     if SlpTim < 1.5:  SlpTim+= Period
-    self.wait( SlpTim )
-
+    return SlpTim
 
-#
-# Specific class definitions.
-# ===========================
-#
 
 #
-# Class Airplane contains the relevant information received from an air plane,
-# augmented with process-related data.
+# Class ExpiryIndex keeps track of the moment at which each entry of a table
+# expires, that is Timeout seconds after it was last seen. The entries are
+# collected in buckets of one second, and the buckets are ordered by time in a
+# heap. An entry which is seen again is added to a later bucket, without being
+# removed from its earlier bucket(s). Thus the caller of method Expire needs to
+# verify that an entry returned has really expired.
 #
-class Airplane():
-  def __init__( self, Id ):
-    self.IcaoAddr= Id			# ICAO address
-    self.CallSign= None			# Flight code
-    self.FrstSeen= None			# Time stamp of first message received
-    self.LastSeen= None			# Time stamp of last message received
-    self.LocatMsg=    0			# Count of messages with location
-    self.TotalMsg=    0			# Total message count
-    self.CurLoc  = None			# Last reported location, [x,y,z]
-    self.PrevLoc = None			# Previous location, carthesian coordinates
-    self.Distance= None			# Closest distance to reference point
-    self.Passed  = False		# Flag: airplane has passed by
+class ExpiryIndex():
+  def __init__( self, timeout ):
+    self.timeout= timeout		# Expiry time, [s]
+    self.slots= {}			# Per bucket the list of keys
+    self.heap = []			# Buckets, ordered by time
+    self.lock = threading.Lock()	# Buckets are shared by threads
 
  #
- # Method ExtractDistance computes from the latitude, the longitude and the
- # altitude the (closest) distance to the reference point. If the closest
- # distance to the linearly extrapolated flight path is in between the two last
- # reported positions, this distance is used rather than the distance calculated
- # from the reported positions.
+ # Method Add registers that the entry with key key is seen at time uts. It
+ # should only be invoked if the integer part of uts has changed since the
+ # previous invocation for the same key.
  #
-  def ExtractDistance( self, lat, long, alt ):
-    newloc= Cartesian( lat, long, alt )
-    if newloc == self.CurLoc:  return
+  def Add( self, key, uts ):
+    b= int( uts )			# Bucket
+    with self.lock:
+      slot= self.slots.get( b )
+      if slot is None:
+        slot= self.slots[b]= []
+        heapq.heappush( self.heap, b )
+      slot.append( key )
 
-    self.PrevLoc= self.CurLoc
-    self.CurLoc = newloc
-
-#    if self.Passed:
-#      return
-  #
-  # Handle the case that this is the first position received for this air plane.
-  # Compute the distance to the reference point and save this distance.
-  #
-    if self.PrevLoc is None:
-      self.Distance= Distance( self.CurLoc, RefPnt['Cartesian'] )
-  #
-  # Handle the case that an earlier position of this airplane is known. Compute
-  # the shortest distance if the point of shortest distance is in between
-  # PrevLoc and CurLoc.
-  #
-    else:
-   #
-   # The straight line L through the two points PrevLoc and CurLoc is
-   # parametrised by variable s, in such a way that L(0) == PrevLoc and L(1) ==
-   # CurLoc. Thus the air plane has passed the reference point if 0 <= s <= 1.
-   #
-      snum= 0 ;  sden= 0
-      p= self.PrevLoc
-      q= self.CurLoc
-      r= RefPnt['Cartesian']
-      for i in range(3):
-        snum+= (q[i] - p[i])*(r[i] - p[i])
-        sden+= (q[i] - p[i])**2
-      s= snum / sden
-   #
-   # If the air plane has passed the reference point, calculate the point in
-   # it's path of minimium distance, which p + s*(q-p).
-   #
-      if 0.0 <= s <= 1.0:
-        self.Passed= True
-        t= [0,0,0]
-        for i in range(3):
-          t[i]= p[i] + s*(q[i] - p[i])
-        d= Distance( t, r )
-      else:
-        d= Distance( q, r )
-      self.Distance= min( self.Distance, d )
+ #
+ # Method Due returns the time at which the next bucket expires, or None if
+ # there are no buckets.
+ #
+  def Due( self ):
+    with self.lock:
+      return self.heap[0] + 1 + self.timeout if self.heap else None
 
-  def SetCallSign( self, cs  ):
-    self.CallSign= cs
+ #
+ # Method Expire removes all buckets which have expired at time now and returns
+ # the keys in those buckets.
+ #
+  def Expire( self, now ):
+    keys= []
+    with self.lock:
+      while self.heap  and  self.heap[0] + 1 + self.timeout <= now:
+        keys.extend( self.slots.pop( heapq.heappop(self.heap) ) )
+    return keys
 
-  def SetLastSeen( self, uts ):
-    if self.FrstSeen is None:  self.FrstSeen= uts
-    self.LastSeen= uts
+ #
+ # Method Pop removes one key from the oldest bucket and returns the start time
+ # of that bucket and the key, or None if there are no keys. As for Expire, the
+ # caller needs to verify that the entry has not been seen later.
+ #
+  def Pop( self ):
+    with self.lock:
+      while self.heap:
+        b= self.heap[0]
+        slot= self.slots[b]
+        if slot:  return (b,slot.pop())
+        del self.slots[heapq.heappop(self.heap)]
+    return None
 
 
 #
-# Class HandleMessages receives the messages from the ADS-B data collector. It
-# creates an Airplane object for each air plane detected and it invokes methods
-# of this object to extract the relevant information.
+# Class MessageRing is the bounded buffer between the thread reading the sockets
+# and the thread processing the messages. Each entry is a batch of messages, as
+# read from a socket in one go. The capacity is expressed in messages. The
+# current depth and its high-water mark are maintained.
 #
-class HandleMessages( StoppableThread ):
-  def __init__( self ):
-    super().__init__()			# Parent initialisation
-    self.name= 'HandleMessages'		# Name of thread
-    self.sock= None
+class MessageRing():
+  def __init__( self, size ):
+    self.size = size			# Capacity, [messages]
+    self.fifo = collections.deque()	# Queued batches
+    self.depth= 0			# Number of queued messages
+    self.hwm  = 0			# High-water mark of depth
+    self.cond = threading.Condition()	# Signals a non-empty buffer
+    self.closed= False			# No more batches will be added
 
  #
- # Private method _attempt_connect tries to connect to the port on which the
- # BaseStation messages are published. In case the connection is refused,
- # implying that no program has bound itself to that port, return error code
- # 111.
+ # Method Put appends a batch of count messages. If it does not fit, the batch
+ # is not added and False is returned.
  #
-  def _attempt_connect( self ):
-    rc= 0				# Preset return code
-    try:
-      self.sock.connect( (ServerHost,ServerPort) )
-    except ConnectionRefusedError as e:
-      rc= e.errno
-    return rc
+  def Put( self, batch, count ):
+    with self.cond:
+      if self.depth + count > self.size:
+        return False
+      self.fifo.append( batch )
+      self.depth+= count
+      if self.depth > self.hwm:  self.hwm= self.depth
+      self.cond.notify()
+    return True
 
  #
- # Private method _start_collector starts the data collector, dump1090, as an
- # independent process.
+ # Method Close marks the end of the stream of batches.
  #
-  def _start_collector( self ):
-    DevNull= subprocess.DEVNULL		# Destination for output
-    pid= subprocess.Popen( ExtCol, stdout=DevNull, stderr=DevNull ).pid
-    time.sleep( 5 )			# Wait for it to become active
-    return pid
-
-  def run(self):
-    self.LogMessage( 'Starting thread' )
+  def Close( self ):
+    with self.cond:
+      self.closed= True
+      self.cond.notify_all()
 
  #
- # Open a TCP-connection to the data collector to retrieve the decoded messages.
- # If the attempt to connect fails with error number 111 (connection refused),
- # try to start the data collector and try once more to build a connection to
- # this program.
+ # Method Get waits at most timeout seconds for the buffer to become non-empty,
+ # and then removes and returns all queued batches.
  #
-    self.sock= socket.socket( socket.AF_INET, socket.SOCK_STREAM )
-    if self._attempt_connect() == 111:
-      self._start_collector()
-      if self._attempt_connect() == 111:
-        self.LogMessage( 'Error: connect failed' )
-        exit( 1 )
+  def Get( self, timeout ):
+    with self.cond:
+      if not self.fifo  and  not self.closed:
+        self.cond.wait( timeout )
+      batches= list( self.fifo )
+      self.fifo.clear()
+      amx['ring_depth'].Observe( self.depth )
+      self.depth= 0
+    return batches
 
-    while not self.stopped():
-      data = self.sock.recv( 2048 )
-      lines= data.decode().split( '\r\n' )
-      for line in lines:
-        if line == '':  continue
 
-        ams['total_messages']+= 1
+#
+# Class Deduplicator detects messages which are received from more than one
+# feed. Per message key the feed and the time of the first reception are saved
+# during a window of window seconds. The keys are also saved in order of
+# reception in a FIFO, such that the expired keys can be removed in constant
+# time per key.
+#
+class Deduplicator():
+  def __init__( self, window ):
+    self.window= window			# Duplicate detection window, [s]
+    self.seen= {}			# Per key the (feed,time) of reception
+    self.fifo= collections.deque()	# Keys in order of reception
+
  #
- # Split up the line into fields. It should result in 22 fields.
+ # Method Purge removes the keys which were received more than self.window
+ # seconds before time now.
  #
-        flds= line.split( ',' )
-        if len(flds) != 22:
-          self.LogMessage( 'Unexpected number of fields in "{}"'.format(line) )
-          ams['erred_messages']+= 1
-          continue
+  def Purge( self, now ):
+    limit= now - self.window
+    while self.fifo  and  self.fifo[0][0] < limit:
+      t,key= self.fifo.popleft()
+      prev= self.seen.get( key )
+      if prev is not None  and  prev[1] == t:
+        del self.seen[key]
+
  #
- # The data collector will send only messages with type MSG. Any other type can
- # be ignored. For completeness however, the occurrence of another message type
- # is logged.
+ # Method IsDuplicate returns True if the message with key key has already been
+ # received from another feed within the window. Otherwise the message is
+ # registered and False is returned.
  #
-        if flds[0] != 'MSG':
-          self.LogMessage( 'Unexpected message type received: "{}"'.format(flds[0]) )
-          ams['erred_messages']+= 1
-          continue
+  def IsDuplicate( self, key, feed, now ):
+    prev= self.seen.get( key )
+    if prev is not None:
+      if prev[0] != feed:
+        return True
+      if prev[1] == now:		# Already queued in the FIFO
+        return False
+    self.seen[key]= (feed,now)
+    self.fifo.append( (now,key) )
+    return False
+
+
+#
+# Class AdmissionFilter holds the messages of the ICAO addresses which are not
+# (yet) in the air plane list. An address is admitted once count messages are
+# received from it within window seconds of the first one. Per address on
+# probation the time of the first message and the messages held are saved. The
+# addresses are also saved in order of arrival in a FIFO, such that the
+# addresses which are not confirmed in time can be removed in constant time per
+# address.
+#
+class AdmissionFilter():
+  def __init__( self, count, window ):
+    self.count = count			# Messages needed to admit an address
+    self.window= window			# Admission window, [s]
+    self.held= {}			# Per address the time and messages held
+    self.fifo= collections.deque()	# Addresses in order of arrival
+
  #
- # Each MSG-message contains a 24-bit ICAO airplane address. Make sure that this
- # identifier exists in the airplane list. However, address 000000(16) is
- # ignored, as the decoding of the address is probably incomplete and as those
- # messages do not give any additional information, relevant to this script.
- # Note that the total number of air planes is not incremented at this time:
- # only when a plane is passed by all the plane related statistics are updated.
+ # Method Purge removes the addresses of which the first message was received
+ # more than self.window seconds before time now, and counts them as rejected.
  #
-        id= flds[4]			# ICAO airplane address
-        if id == '000000':
-          ams['zero_id_messages']+= 1
-          continue
+  def Purge( self, now ):
+    limit= now - self.window
+    while self.fifo  and  self.fifo[0][0] < limit:
+      t,id= self.fifo.popleft()
+      held= self.held.get( id )
+      if held is not None  and  held[0] == t:
+        del self.held[id]
+        aps.Local()['rejected_airplane']+= 1
 
-        if id not in apl:
-          apl[id]= Airplane( id )	# Enter airplane in list
-        apl[id].SetLastSeen( time.time() )	# Save time of last MSG received
-        apl[id].TotalMsg+= 1		# Increment total message count
- #
- # Do the transmission-type-dependent handling. Extract the flight name and of
- # course the reported positions from the message stream.
- #
-        tt= int(flds[1])		# Transmission type
-        if   tt == 1:
-          apl[id].SetCallSign( flds[10] )	# Save call sign
-          ams['procd_messages']+= 1	# Update processed message count
-        elif tt == 3:
-          apl[id].ExtractDistance( float(flds[14]), float(flds[15]), int(flds[11]) )
-          apl[id].LocatMsg+= 1		# Update number of position messages
-          ams['procd_messages']+= 1	# Update processed message count
-        elif tt in [2,4,5,6,7,8]:
-          pass				# No relevant info in message
-        else:
-          self.LogMessage( 'Unexpected MSG transmission type received: {}'.format(tt) )
-          ams['erred_messages']+= 1
-          continue
+ #
+ # Method Admit handles message rec, a tuple (id,tt,...), received at time uts
+ # from an address which is not in the air plane list. If the address is
+ # admitted, the list of the messages held before, as tuples (rec,uts), is
+ # returned. Otherwise the message is held and None is returned.
+ #
+  def Admit( self, rec, uts ):
+    if self.count <= 1:  return []
+    self.Purge( uts )
+    id= rec[0]
+    held= self.held.get( id )
+    if held is None:
+      self.held[id]= [ uts, (rec,uts) ]
+      self.fifo.append( (uts,id) )
+      return None
+    if len(held) < self.count:		# Time stamp plus count-1 messages
+      held.append( (rec,uts) )
+      return None
+    del self.held[id]
+    return held[1:]
 
-    self.sock.close()
-    self.LogMessage( 'Stopping thread' )
 
 #
-# Thread CleanAirplaneList periodically scans the list of air planes, and it
-# will remove those planes which have not been seen since at least 60 [s]. The
-# statistics are then updated and a line is written to the logfile.
+# Class PlaneArchive appends the records of the passed air planes to the
+# segments of the archive in directory path. The segment is determined by the
+# date of the time the air plane was last seen. After appending a record, the
+# index entry of its block is updated.
 #
-class CleanAirplaneList( StoppableThread ):
-  def __init__( self ):
-    super().__init__()			# Parent initialisation
-    self.name= 'CleanAirplaneList'	# Name of thread
-    self.outfil= None
-
-  def run( self ):
-    self.LogMessage( 'Starting thread' )
-    self.outfil= open( '/home/pi/air/plane.log', 'a' )
-    tf= EncodeDateTime( sosts )
-    self.outfil.write( '{} Start data acquisition\n'.format(tf) )
-
-    while not self.stopped():
-      now= time.time()
-      for id in list(apl):		# Do NOT use an iterator
-        if now - apl[id].LastSeen < 120:  continue
-        aps['total_airplane']+= 1
-        sd= apl[id].Distance		# Shortest distance
-        dc= ClassifyDistance( sd )	# Distance class
-        aps[dc]+= 1
+class PlaneArchive():
+  def __init__( self, path ):
+    self.path= path			# Directory of archive
+    self.day = None			# Date of open segment
+    self.dat = None			# Segment file
+    self.idx = None			# Index file
+    self.count= 0			# Number of records in segment
+    self.lo= self.hi= 0			# Time range of current block
+    os.makedirs( path, exist_ok=True )
 
-        if apl[id].Distance is not None:
-          tf= EncodeDateTime( apl[id].FrstSeen )
-          tl= EncodeDateTime( apl[id].LastSeen )
-          cs= apl[id].CallSign	if apl[id].CallSign is not None else '??'
-          mc= apl[id].LocatMsg
-          di= '{:6d}'.format(int(apl[id].Distance))
-          self.outfil.write( '{} {} {} {:8} {:3d} {}\n'.format(tf,tl,apl[id].IcaoAddr,cs,mc,di) )
+ #
+ # Private method _open opens the segment of day day for appending. A partial
+ # record at the end, left by an interrupted write, is removed and the time
+ # range of the last, incomplete block is recomputed.
+ #
+  def _open( self, day ):
+    self.Close()
+    base= os.path.join( self.path, day )
+    self.dat= open( base + '.apd', 'a+b' )
+    size= os.path.getsize( base + '.apd' )
+    self.count= size // ArchiveRecord.size
+    if size % ArchiveRecord.size:
+      self.dat.truncate( self.count*ArchiveRecord.size )
+    self.idx= open( base + '.idx', 'r+b' if os.path.exists(base + '.idx') else 'w+b' )
+    blk= self.count // ArchiveBlock
+    if self.count % ArchiveBlock:
+      self.dat.seek( blk*ArchiveBlock*ArchiveRecord.size )
+      last= [ r[1] for r in ArchiveRecord.iter_unpack( self.dat.read() ) ]
+      self.lo,self.hi= min(last), max(last)
+      self.idx.seek( blk*ArchiveIndex.size )
+      self.idx.write( ArchiveIndex.pack(self.lo,self.hi) )
+    self.day= day
 
-        del apl[id]			# Finally, delete the entry
+ #
+ # Method Append adds the record of one passed air plane. An unknown distance
+ # is saved as NaN.
+ #
+  def Append( self, frst, last, icao, call, locat, dist ):
+    day= time.strftime( '%Y%m%d', time.localtime(last) )
+    if day != self.day:  self._open( day )
+    try:
+      addr= int( icao, 16 )
+    except ValueError:
+      addr= 0
+    cs= ( call or '' ).strip().encode( 'ascii', 'replace' )
+    self.dat.write( ArchiveRecord.pack( int(frst), int(last), addr, locat,
+                      math.nan if dist is None else dist, cs ) )
+    if self.count % ArchiveBlock == 0:	# Start of a new block
+      self.lo= self.hi= int( last )
+    else:
+      self.lo= min( self.lo, int(last) ) ;  self.hi= max( self.hi, int(last) )
+    self.idx.seek( (self.count // ArchiveBlock)*ArchiveIndex.size )
+    self.idx.write( ArchiveIndex.pack(self.lo,self.hi) )
+    self.count+= 1
 
-      time.sleep( 1 )
+  def Flush( self ):
+    if self.dat is not None:
+      self.dat.flush() ;  self.idx.flush()
 
-    self.outfil.close()
-    self.LogMessage( 'Stopping thread' )
+  def Close( self ):
+    if self.dat is not None:
+      self.dat.close() ;  self.idx.close()
+      self.dat= self.idx= self.day= None
 
 
 #
-# Class MonitorAirspace retrieves periodically the statistics collected by
-# classes / threads HandleMessages and CleanAirplaneList, formats them into
-# status messages for the xymon server, and sends them to the server.
+# Class DistanceRollup maintains histograms of the closest distance at multiple
+# resolutions in constant memory. Per resolution, the rows form a ring buffer;
+# each row is tagged with the number of the period it covers. A row is cleared
+# when it is reused for a newer period. Adding a passed air plane takes constant
+# time per resolution, as the distance bins have a fixed width.
 #
-class MonitorAirspace( StoppableThread ):
-  """Class MonitorAirspace reports some statistics about the air planes in the
-     neighbourhood to the Xymon server."""
+class DistanceRollup():
+  def __init__( self, resolutions, rows, step, bins ):
+    self.res = resolutions		# Period per resolution, [s]
+    self.rows= rows			# Rows per resolution
+    self.step= step			# Width of distance bin, [m]
+    self.bins= bins			# Number of distance bins
+    self.width= bins + 2		# Columns: bins, overflow and unknown
+    self.hist= [ array.array( 'I', bytes(4*rows*self.width) ) for r in resolutions ]
+    self.tags= [ array.array( 'q', [-1]*rows ) for r in resolutions ]
+    self.lock= threading.Lock()		# Rows are read by another thread
 
-  def __init__( self ):
-    super().__init__()
-    self.name= 'MonitorAirspace'
-    self.oldstats= None
+ #
+ # Method Add counts an air plane which passed at time uts at distance dist,
+ # which is None if unknown.
+ #
+  def Add( self, uts, dist ):
+    if dist is None:
+      col= self.bins + 1
+    else:
+      col= min( int(dist // self.step), self.bins )
+    with self.lock:
+      for i,res in enumerate( self.res ):
+        period= int( uts // res )
+        row= period % self.rows
+        base= row*self.width
+        if self.tags[i][row] != period:	# Reuse row for a new period
+          if self.tags[i][row] > period:  continue	# Too old
+          self.hist[i][base:base+self.width]= array.array( 'I', bytes(4*self.width) )
+          self.tags[i][row]= period
+        self.hist[i][base+col]+= 1
 
-  def _message_stats( self ):
-    msg = "<p style='text-align:center'><b>ADS-B statistics</b></p>\n\n"
-    msg+= "<table cellpadding=5>\n"
-    msg+= "  <tr> <th>Key</th> <th>Count []</th> </tr>\n"
-    for key in ('total_messages','procd_messages', 'zero_id_messages','erred_messages' ):
-      msg+= "  <tr> <td>{}</td> <td>{:8d}</td> </tr>\n".format(key,ams[key])
-    msg+= "</table>\n\n"
+ #
+ # Method Rows returns for resolution res the most recent count rows, as a list
+ # of tuples containing the start time of the period and the counts per bin,
+ # ordered by time.
+ #
+  def Rows( self, res, count=None ):
+    i= self.res.index( res )
+    with self.lock:
+      rows= [ (self.tags[i][r]*res, self.hist[i][r*self.width:(r+1)*self.width].tolist())
+              for r in range(self.rows) if self.tags[i][r] >= 0 ]
+    rows.sort()
+    return rows[-count:] if count else rows
+
+ #
+ # Method Labels returns the names of the columns of a row.
+ #
+  def Labels( self ):
+    labels= [ '{}-{}'.format( i*self.step, (i+1)*self.step ) for i in range(self.bins) ]
+    return labels + [ '{}-inf'.format(self.bins*self.step), 'unknown' ]
+
+ #
+ # Method Pack returns the layout and the compressed rows, to be saved in a
+ # snapshot. The rows are saved in the byte order of this host, as a snapshot is
+ # read back on the same host.
+ #
+  def Pack( self ):
+    with self.lock:
+      rows= b''.join( [ t.tobytes() for t in self.tags ] + [ h.tobytes() for h in self.hist ] )
+    rows= zlib.compress( rows )
+    return SnapRollup.pack( len(self.res), self.rows, self.width, self.step, len(rows) ) + \
+           struct.pack( '<{}q'.format(len(self.res)), *self.res ) + rows
+
+ #
+ # Method Unpack reads the rows saved by method Pack from data, starting at
+ # offset pos. It returns the rows, or None if the layout has changed, and the
+ # offset following them. The rows are restored by method Restore.
+ #
+  def Unpack( self, data, pos ):
+    nres,rows,width,step,size= SnapRollup.unpack_from( data, pos )
+    pos+= SnapRollup.size
+    res= struct.unpack_from( '<{}q'.format(nres), data, pos ) ;  pos+= 8*nres
+    blob= data[pos:pos+size] ;  pos+= size
+    if len(blob) != size:  raise struct.error( 'Truncated rollups' )
+    if ( res, rows, width, step ) != ( tuple(self.res), self.rows, self.width, self.step ):
+      return (None,pos)
+    blob= zlib.decompress( blob )
+    nt= 8*rows ;  nh= 4*rows*width ;  base= nres*nt	# Octets per ring
+    if len(blob) != nres*( nt + nh ):  raise struct.error( 'Malformed rollups' )
+    tags= [ array.array( 'q', blob[i*nt:(i+1)*nt] ) for i in range(nres) ]
+    hist= [ array.array( 'I', blob[base+i*nh:base+(i+1)*nh] ) for i in range(nres) ]
+    return ((tags,hist),pos)
+
+ #
+ # Method Restore replaces the rows by rows, as returned by method Unpack.
+ #
+  def Restore( self, rows ):
+    with self.lock:
+      self.tags,self.hist= rows
+
+
+#
+# Class BeastReader reads a stream of Mode S messages in Beast binary format
+# from a socket. Each frame starts with octet 0x1A, followed by the frame type,
+# a 6-octet time stamp, a signal level octet and the message. An octet 0x1A
+# within a frame is doubled. Only the long (112 bit) messages are returned; the
+# other frames are skipped based on their type.
+#
+class BeastReader():
+  FrameLength= { 0x31: 2, 0x32: 7, 0x33: 14 }	# Message length per frame type
+
+  def __init__( self, sock, size=ReadSize ):
+    self.sock= sock			# Socket to read from
+    self.size= size			# Octets per read
+    self.buf = bytearray()		# Unprocessed octets
+
+ #
+ # Method ReadFrames waits for the next chunk of data and returns the list of
+ # long messages received so far. None is returned if the peer has closed the
+ # connection.
+ #
+  def ReadFrames( self ):
+    data= self.sock.recv( self.size )
+    if not data:  return None		# Connection closed by peer
+    amx['read_size'].Observe( len(data) )
+    return self.Feed( data )
+
+ #
+ # Method Feed adds a chunk of data to the buffer and returns the list of long
+ # messages which are complete.
+ #
+  def Feed( self, data ):
+    buf= self.buf
+    buf+= data
+    msgs= [] ;  pos= 0 ;  n= len( buf )
+    while True:
+      i= buf.find( 0x1a, pos )
+      if i < 0  or  i+1 >= n:
+        pos= n if i < 0 else i
+        break
+      size= self.FrameLength.get( buf[i+1] )
+      if size is None:			# Escaped 0x1A or unknown type
+        pos= i + 2 if buf[i+1] == 0x1a else i + 1
+        continue
+      end= i + 9 + size			# End of frame without escapes
+      if end > n:
+        pos= i
+        break
+      frame= buf[i+2:end]
+      if 0x1a in frame:			# Frame contains escaped octets
+        frame,end= self._unescape( buf, i+2, 7+size )
+        if frame is None:
+          if end < 0:  pos= i ;  break	# Incomplete frame
+          pos= end ;  continue		# Damaged frame, resynchronise
+      if size == 14:
+        msgs.append( bytes( frame[7:] ) )
+      pos= end
+    del buf[:pos]
+    return msgs
+
+ #
+ # Private method _unescape extracts count octets, starting at position start,
+ # removing the escapes. It returns the octets and the position of the end of
+ # the frame. If the frame is incomplete, (None,-1) is returned. If a 0x1A
+ # octet is not doubled, the frame is damaged and (None,position) is returned.
+ #
+  def _unescape( self, buf, start, count ):
+    out= bytearray() ;  j= start ;  n= len( buf )
+    while len(out) < count:
+      if j >= n:  return (None,-1)
+      c= buf[j]
+      if c == 0x1a:
+        if j+1 >= n:  return (None,-1)
+        if buf[j+1] != 0x1a:  return (None,j)
+        j+= 1
+      out.append( c )
+      j+= 1
+    return (out,j)
+
+
+#
+# Class ModeSDecoder decodes the ADS-B messages (DF 17 and DF 18 with CF 0)
+# needed by this script: identification and airborne position with barometric
+# altitude. The decoded message is returned as a tuple, starting with the ICAO
+# address as a hexadecimal string and the BaseStation transmission type: either
+# (id,1,callsign), (id,3,lat,lon,alt) or (id,0) for any other ADS-B message.
+# A position is decoded globally from a pair of even and odd messages received
+# within 10 [s], otherwise locally relative to the previous position of the air
+# plane. The first position of an air plane is only accepted from such a pair,
+# as a local decoding relative to the reference point is ambiguous beyond 180
+# NM, which is less than BeastRange.
+#
+class ModeSDecoder():
+  Charset= '#ABCDEFGHIJKLMNOPQRSTUVWXYZ##### ###############0123456789######'
+
+  def __init__( self ):
+    self.cpr= {}			# Per ICAO address the CPR state
+    self.purged= 0			# Time of last purge of CPR state
+
+ #
+ # Method Decode decodes message msg, received at time now. It returns None if
+ # the message is not an ADS-B message.
+ #
+  def Decode( self, msg, now ):
+    df= msg[0] >> 3
+    if df != 17  and  not ( df == 18 and (msg[0] & 7) == 0 ):
+      return None
+    id= msg[1:4].hex().upper()
+    me= int.from_bytes( msg[4:11], 'big' )
+    tc= me >> 51			# Type code
+    if 1 <= tc <= 4:			# Identification
+      cs= ''.join( self.Charset[(me >> (42-6*k)) & 0x3f] for k in range(8) )
+      return (id,1,cs.rstrip(' #'))
+    if 9 <= tc <= 18:			# Airborne position, barometric altitude
+      a= (me >> 36) & 0xfff
+      if not a & 0x10:  return (id,0)	# Gillham coded altitude is not used
+      alt= ( ((a & 0xfe0) >> 1) | (a & 0xf) )*25 - 1000
+      pos= self._position( id, (me >> 34) & 1, (me >> 17) & 0x1ffff, me & 0x1ffff, now )
+      if pos is None:  return (id,0)
+      return (id,3,pos[0],pos[1],alt)
+    return (id,0)
+
+ #
+ # Private method _position decodes the CPR encoded position of air plane id.
+ # None is returned if there is no position yet, that is if no pair of even and
+ # odd messages has been received. The position is rejected if it is further
+ # than BeastRange from the reference point.
+ #
+  def _position( self, id, odd, latc, lonc, now ):
+    if now - self.purged > 60:		# Discard state of departed air planes
+      for k in [ k for k,v in self.cpr.items() if now - v[3] > PlaneTimeout ]:
+        del self.cpr[k]
+      self.purged= now
+    st= self.cpr.get( id )
+    if st is None:
+      st= self.cpr[id]= [ None, None, None, now ]	# Even, odd, last position, time
+    st[odd]= (latc,lonc,now)
+    st[3]  = now
+    pos= None
+    other= st[1-odd]
+    if other is not None  and  now - other[2] <= 10:
+      even,oddp= (other,st[1]) if odd else (st[0],other)
+      pos= CprGlobal( even, oddp, odd )
+    if pos is None:
+      if st[2] is None:  return None	# Wait for a global position
+      pos= CprLocal( odd, latc, lonc, st[2][0], st[2][1] )
+    dy= math.radians( pos[0] - RefPnt['Latitude'] )
+    dx= math.radians( pos[1] - RefPnt['Longitude'] )*math.cos( math.radians(pos[0]) )
+    if Earth*math.hypot( dx, dy ) > BeastRange:
+      return None
+    st[2]= pos
+    return pos
+
+
+#
+# Class LineReader reads the message stream from a socket and splits it into
+# lines. The octets are received into a preallocated buffer. A partial line at
+# the end of a read is retained and is completed by the next read(s), thus no
+# message is lost if it happens to straddle the boundary of two reads.
+#
+class LineReader():
+  def __init__( self, sock, size=ReadSize, maxline=MaxLine ):
+    self.sock= sock			# Socket to read from
+    self.size= size			# Octets per read
+    self.buf = bytearray( size + maxline )	# Receive buffer
+    self.view= memoryview( self.buf )	# Zero-copy access to buffer
+    self.fill= 0			# Number of octets in buffer
+
+ #
+ # Method ReadLines waits for the next chunk of data and returns the list of
+ # complete lines received so far, without line terminators. The list may be
+ # empty if no line is completed yet. None is returned if the peer has closed
+ # the connection.
+ #
+  def ReadLines( self ):
+    n= self.sock.recv_into( self.view[self.fill:], min(self.size,len(self.buf)-self.fill) )
+    if n == 0:  return None		# Connection closed by peer
+    amx['read_size'].Observe( n )
+    return self._frame( n )
+
+ #
+ # Method Feed adds a chunk of data, received by other means than by reading
+ # from self.sock, to the buffer and returns the list of complete lines.
+ #
+  def Feed( self, data ):
+    lines= []
+    data = memoryview( data )
+    while len(data) > 0:
+      n= min( len(data), len(self.buf)-self.fill )
+      self.view[self.fill:self.fill+n]= data[:n]
+      lines.extend( self._frame(n) )
+      data= data[n:]
+    return lines
+
+ #
+ # Private method _frame accounts for n octets added to the buffer, and returns
+ # the list of complete lines in the buffer.
+ #
+  def _frame( self, n ):
+    self.fill+= n
+
+    end= self.buf.rfind( b'\n', 0, self.fill ) + 1
+    if end == 0:			# No line terminator found
+      if self.fill < len(self.buf):  return []
+      end= self.fill			# Buffer full: flush garbage
+    lines= bytes( self.view[:end] ).decode( errors='replace' ).splitlines()
+ #
+ # Move the partial line, if any, to the start of the buffer. A memoryview copy
+ # handles overlapping ranges correctly.
+ #
+    rest= self.fill - end
+    if rest > 0:
+      self.view[:rest]= self.view[end:self.fill]
+    self.fill= rest
+    return lines
+
+
+#
+# Class Histogram collects the distribution of a metric in logarithmic bins. The
+# upper bound of bin b is unit*2**b. Recording a value takes a few operations
+# only, thus it can be used in the hot path. Updates from multiple threads are
+# not locked: a lost update is acceptable for a metric.
+#
+class Histogram():
+  Bins= 40				# Number of bins
+
+  def __init__( self, unit ):
+    self.unit = unit			# Upper bound of bin 0
+    self.bins = [0]*self.Bins		# Count per bin
+    self.count= 0			# Number of values
+    self.total= 0			# Sum of values
+    self.max  = 0			# Maximum value
+
+  def Observe( self, value ):
+    self.count+= 1
+    self.total+= value
+    if value > self.max:  self.max= value
+    b= math.frexp( value/self.unit )[1]
+    self.bins[ min(max(b,0),self.Bins-1) ]+= 1
+
+ #
+ # Method Quantile returns an upper bound of quantile q, 0 < q <= 1.
+ #
+  def Quantile( self, q ):
+    need= q*self.count ;  seen= 0
+    for b,n in enumerate( self.bins ):
+      seen+= n
+      if seen >= need  and  seen > 0:
+        return min( self.unit*2**b, self.max )
+    return 0
+
+ #
+ # Method Format returns a one line summary of the histogram.
+ #
+  def Format( self, name ):
+    mean= self.total/self.count if self.count > 0 else 0
+    return '{:16} {:9d} {:11.4g} {:11.4g} {:11.4g} {:11.4g} {:11.4g}'.format(
+             name, self.count, mean, self.Quantile(0.5), self.Quantile(0.9),
+             self.Quantile(0.99), self.max )
+
+#
+# Class Counters is a set of named counters, which are incremented by multiple
+# threads. Each thread increments its own copy of the counters, obtained with
+# method Local, thus no lock is needed in the hot path and no increment is lost.
+# Reading a counter returns the sum of the copies of all threads. Setting a
+# counter, which is only done at start up, adjusts the copy of the calling
+# thread such that the sum has the requested value.
+#
+class Counters():
+  def __init__( self, **init ):
+    self.init = init			# Initial value per counter
+    self.parts= []			# Copies of the counters, one per thread
+    self.local= threading.local()	# Copy of the current thread
+    self.lock = threading.Lock()	# Protects list parts
+
+  def Local( self ):
+    try:
+      return self.local.part
+    except AttributeError:
+      part= self.local.part= dict.fromkeys( self.init, 0 )
+      with self.lock:
+        self.parts.append( part )
+      return part
+
+ #
+ # Method Copy returns the values of all counters in a dictionary. Each copy is
+ # taken in one step, thus the counters of one thread are consistent.
+ #
+  def Copy( self ):
+    with self.lock:
+      parts= [ part.copy() for part in self.parts ]
+    total= dict( self.init )
+    for part in parts:
+      for key,val in part.items():
+        total[key]+= val
+    return total
+
+  def items( self ):
+    return self.Copy().items()
+
+  def __contains__( self, key ):
+    return key in self.init
+
+  def __iter__( self ):
+    return iter( self.init )
+
+  def __getitem__( self, key ):
+    with self.lock:
+      return self.init[key] + sum( part[key] for part in self.parts )
+
+  def __setitem__( self, key, val ):
+    self.Local()[key]+= val - self[key]
+
+#
+# Allocate the statistics counters and the hot path metrics.
+#
+ams= Counters(				# ADS-B message statistics
+  total_messages= 0,			# Total number of messages received
+  procd_messages= 0,			# Number of processed messages
+  zero_id_messages= 0,			# Number of messages with a null ICAO address
+  erred_messages= 0,			# Number of erred messages received
+  dupl_messages= 0,			# Number of duplicate messages of other feeds
+  drop_messages= 0,			# Number of messages dropped, ring buffer full
+)
+aps= Counters(				# Air plane statistics
+  total_airplane= 0,			# Total number of airplanes detected
+  rejected_airplane= 0,			# Number of addresses not admitted
+  evicted_airplane= 0,			# Number of air planes evicted, list full
+  published_events= 0,			# Number of pass events published
+  dropped_events= 0,			# Number of events dropped, queue full
+  **dict.fromkeys( [ i[0] for i in DistClass ], 0 )	# Counter per distance class
+)
+amx= dict(				# Hot path metrics
+  message_rate= Histogram( 1    ),	# Messages per second
+  batch_size  = Histogram( 1    ),	# Messages per socket read
+  read_size   = Histogram( 1    ),	# Octets per socket read
+  backlog     = Histogram( 1    ),	# Octets waiting in socket, per second
+  parse_time  = Histogram( 1e-6 ),	# Time to parse a batch, [s]
+  extract_time= Histogram( 1e-6 ),	# Time to compute distances of a batch, [s]
+  expire_time = Histogram( 1e-6 ),	# Time of an expiry pass, [s]
+  airplanes   = Histogram( 1    ),	# Size of air plane list, per expiry pass
+  xymon_time  = Histogram( 1e-3 ),	# Time to send a Xymon message, [s]
+  ring_depth  = Histogram( 1    ),	# Messages in ring buffer, per drain
+)
+
+
+#
+# Specific class definitions.
+# ===========================
+#
+
+#
+# Class Airplane contains the relevant information received from an air plane,
+# augmented with process-related data. As many instances may exist at the same
+# time, the attributes are stored in slots rather than in a per-instance
+# dictionary, which reduces the memory needed per air plane considerably.
+#
+class Airplane():
+  __slots__= ( 'IcaoAddr', 'CallSign', 'FrstSeen', 'LastSeen', 'LocatMsg',
+               'TotalMsg', 'CurLoc', 'PrevLoc', 'Distance', 'Dists', 'Passed',
+               'Notified' )
+
+  def __init__( self, Id ):
+    self.IcaoAddr= Id			# ICAO address
+    self.CallSign= None			# Flight code
+    self.FrstSeen= None			# Time stamp of first message received
+    self.LastSeen= None			# Time stamp of last message received
+    self.LocatMsg=    0			# Count of messages with location
+    self.TotalMsg=    0			# Total message count
+    self.CurLoc  = None			# Last reported location, cartesian [x,y,z]
+    self.PrevLoc = None			# Previous location, cartesian [x,y,z]
+    self.Distance= None			# Closest distance to reference point
+    self.Dists   = None			# Closest distances to points in RefPnts
+    self.Passed  = False		# Flag: airplane has passed by
+    self.Notified= math.inf		# Distance in last pass event
+
+ #
+ # Method ExtractDistance computes from the latitude, the longitude and the
+ # altitude the (closest) distance to the reference point. If the closest
+ # distance to the linearly extrapolated flight path is in between the two last
+ # reported positions, this distance is used rather than the distance calculated
+ # from the reported positions. If the flight path lies too far away to improve
+ # on the distance found so far, see function SegmentBound, the distance is not
+ # computed.
+ #
+  def ExtractDistance( self, lat, long, alt ):
+    newloc= Cartesian( lat, long, alt )
+    if newloc == self.CurLoc:  return
+
+    self.PrevLoc= self.CurLoc
+    self.CurLoc = newloc
+
+#    if self.Passed:
+#      return
+  #
+  # Handle the case that this is the first position received for this air plane.
+  # Compute the distance to the reference point and save this distance.
+  #
+    if self.PrevLoc is None:
+      self.Distance= Distance( self.CurLoc, Origin )
+      if RefPnts:
+        self.Dists= MinDistances( self.Dists, PointDistances( None, self.CurLoc ) )
+  #
+  # Handle the case that an earlier position of this airplane is known. If the
+  # flight path from PrevLoc to CurLoc cannot come closer by than the distance
+  # found so far and the air plane has already passed by, there is nothing to
+  # compute. Otherwise compute the shortest distance if the point of shortest
+  # distance is in between PrevLoc and CurLoc.
+  #
+    else:
+      p= self.PrevLoc
+      q= self.CurLoc
+      r= Origin
+      bound= SegmentBound( p, q )
+      if bound < self.Distance  or  not self.Passed:
+   #
+   # The straight line L through the two points PrevLoc and CurLoc is
+   # parametrised by variable s, in such a way that L(0) == PrevLoc and L(1) ==
+   # CurLoc. Thus the air plane has passed the reference point if 0 <= s <= 1.
+   #
+        snum= 0 ;  sden= 0
+        for i in range(3):
+          snum+= (q[i] - p[i])*(r[i] - p[i])
+          sden+= (q[i] - p[i])**2
+        s= snum / sden
+        hit= 0.0 <= s <= 1.0
+        if hit:
+          self.Passed= True
+   #
+   # If the air plane has passed the reference point, calculate the point in
+   # it's path of minimium distance, which p + s*(q-p).
+   #
+        if bound < self.Distance:
+          if hit:
+            t= [0,0,0]
+            for i in range(3):
+              t[i]= p[i] + s*(q[i] - p[i])
+            d= Distance( t, r )
+          else:
+            d= Distance( q, r )
+          self.Distance= min( self.Distance, d )
+   #
+   # The distance of a point in RefPnts to the flight path is at least the bound
+   # minus the distance of that point to the reference point.
+   #
+      if RefPnts:
+        if self.Dists is None  or  bound - RefReach < MaxDistance( self.Dists ):
+          self.Dists= MinDistances( self.Dists, PointDistances( p, q ) )
+
+    if aev is not None  and  self.Passed:
+      self.ConfirmPass()
+
+ #
+ # Method ConfirmPass publishes a pass event once the air plane has passed the
+ # reference point and is moving away from it, that is if the range of the last
+ # reported position is larger than the one of the previous position. If the
+ # air plane turns back and passes closer by, a revise event with the new
+ # distance is published. The distance in the log, which is written once the
+ # air plane has expired, may thus be smaller than the one in the first event.
+ #
+  def ConfirmPass( self ):
+    if self.Distance >= self.Notified  or  self.PrevLoc is None:  return
+    if Distance( self.CurLoc, Origin ) <= Distance( self.PrevLoc, Origin ):  return
+    kind= 'pass' if self.Notified == math.inf else 'revise'
+    self.Notified= self.Distance
+    aev.Publish( kind, self )
+
+  def SetCallSign( self, cs  ):
+    self.CallSign= cs
+
+  def SetLastSeen( self, uts ):
+    if self.FrstSeen is None:
+      self.FrstSeen= uts
+    elif int(uts) == int(self.LastSeen):
+      self.LastSeen= uts
+      return
+    self.LastSeen= uts
+    apx.Add( self.IcaoAddr, uts )	# Update expiry index
+
+
+#
+# Function FormatPlane returns the ICAO address, the call sign, the number of
+# position messages and the closest distances of air plane ap, of which the
+# distance is known, in the layout of the log of passed air planes.
+#
+def FormatPlane( ap ):
+  cs= ap.CallSign	if ap.CallSign is not None else '??'
+  di= '{:6d}'.format(int(ap.Distance))
+  if ap.Dists is not None:
+    di+= ''.join( ' {:6d}'.format(int(d)) for d in ap.Dists )
+  return '{} {:8} {:3d} {}'.format(ap.IcaoAddr,cs,ap.LocatMsg,di)
+
+#
+# Function EnterAirplane creates the entry of the air plane with ICAO address
+# id in the air plane list and returns it. If the list already contains
+# MaxPlanes air planes, the air planes seen least recently are evicted first.
+# They are passed via deque apv to CleanAirplaneList, which records them at its
+# next expiry pass. Thread CleanAirplaneList may remove the same air plane
+# meanwhile, thus only a successful removal counts.
+#
+def EnterAirplane( id ):
+  while len(apl) >= MaxPlanes:
+    old= apx.Pop()
+    if old is None:  break
+    b,key= old
+    ap= apl.get( key )
+    if ap is None  or  int(ap.LastSeen) != b:  continue
+    if apl.pop( key, None ) is not None:
+      aps.Local()['evicted_airplane']+= 1
+      apv.append( ap )
+  ap= apl[id]= Airplane( id )
+  return ap
+
+#
+# Function PassedOrder returns the key to sort the passed air planes on: the
+# time they were last seen and their ICAO address.
+#
+def PassedOrder( ap ):
+  return (ap.LastSeen,ap.IcaoAddr)
+
+#
+# Function ExtractDistances is the batch version of method
+# Airplane.ExtractDistance. It handles a sequence of position reports, in order
+# of arrival, in which report i is received from air plane planes[i]. If module
+# numpy is available, the positions are converted to cartesian coordinates and
+# projected onto the reference point in one vectorised pass, after which the
+# minimum distance per air plane is determined with a grouped reduction. The
+# result is the same as invoking ExtractDistance per report.
+#
+def ExtractDistances( planes, lats, longs, alts ):
+  n= len( planes )
+  if numpy is None  or  n < BatchMin:
+    for i in range(n):
+      planes[i].ExtractDistance( lats[i], longs[i], alts[i] )
+    return
+ #
+ # Number the air planes in order of their first report, and find per report the
+ # index of the previous report of the same air plane, or -1 if there is none.
+ # Then compute the cartesian coordinates of all positions, in order of arrival.
+ #
+  grp= {} ;  gid= [0]*n ;  prv= [0]*n ;  tail= []
+  for i,pln in enumerate( planes ):
+    g= grp.get( pln )
+    if g is None:
+      g= grp[pln]= len( tail )
+      tail.append( -1 )
+    gid[i]= g ;  prv[i]= tail[g] ;  tail[g]= i
+  plns= list( grp )			# Air plane per group
+  gid = numpy.array( gid ) ;  prv= numpy.array( prv )
+
+  q= Cartesians( numpy.asarray( lats , dtype=float ),
+                 numpy.asarray( longs, dtype=float ),
+                 numpy.asarray( alts , dtype=float ) )
+ #
+ # Determine the previous position of each report. For the first report of an
+ # air plane it is its last known position, if any, otherwise NaN. A report with
+ # the same position as its predecessor yields the distance of that position,
+ # which has been taken into account already, thus it needs no special care.
+ #
+  nan= (math.nan,)*3
+  last= numpy.array( [ nan if pln.CurLoc is None else pln.CurLoc for pln in plns ] )
+  p= numpy.where( (prv >= 0)[:,None], q[prv], last[gid] )
+ #
+ # Compute per report the distance to the reference point. If the point of
+ # closest approach on the straight line through p and q lies in between those
+ # two points, it is used instead of q.
+ #
+  r= numpy.asarray( Origin )
+  d= q - p
+  with numpy.errstate( invalid='ignore', divide='ignore' ):
+    s= numpy.einsum( 'ij,ij->i', d, r - p ) / numpy.einsum( 'ij,ij->i', d, d )
+  hit= (s >= 0.0) & (s <= 1.0)		# False if s is NaN
+  t= numpy.where( hit[:,None], p + s[:,None]*d, q )
+  dist= numpy.sqrt( numpy.einsum( 'ij,ij->i', t - r, t - r ) )
+ #
+ # Sort the reports on air plane, such that the minimum per air plane can be
+ # determined with a grouped reduction.
+ #
+  order= numpy.argsort( gid, kind='stable' )
+  strt = numpy.zeros( len(plns), dtype=numpy.intp )
+  strt[1:]= numpy.cumsum( numpy.bincount( gid ) )[:-1]
+  dmin= numpy.minimum.reduceat( dist[order], strt ).tolist()
+  pasd= ( numpy.bincount( gid, weights=hit ) > 0 ).tolist()
+ #
+ # Compute the distances to the points in RefPnts for all reports in matrix
+ # operations, resulting in a K x N matrix for K points and N reports. The
+ # squared distance of point a to the point of closest approach equals |a-p|**2
+ # - s**2*|d|**2, in which s is computed per point and report. The coordinates
+ # are relative to the reference point, which retains precision. The cost of
+ # these operations is dominated by their fixed overhead for K up to a few
+ # hundred points.
+ #
+  if RefPnts:
+    pr= p - r ;  qr= q - r
+    dd= numpy.einsum( 'ij,ij->i', d, d )
+    with numpy.errstate( invalid='ignore', divide='ignore' ):
+      sk= ( RefRel @ d.T - numpy.einsum('ij,ij->i',pr,d) ) / dd
+      d2= numpy.where( (sk >= 0.0) & (sk <= 1.0),
+            RefRR - 2*( RefRel @ pr.T ) + numpy.einsum('ij,ij->i',pr,pr) - sk*sk*dd,
+            RefRR - 2*( RefRel @ qr.T ) + numpy.einsum('ij,ij->i',qr,qr) )
+    dk  = numpy.sqrt( numpy.maximum( d2, 0.0 ) )
+    kmin= numpy.minimum.reduceat( dk[:,order], strt, axis=1 ).T
+    if not RefVect:  kmin= kmin.tolist()
+ #
+ # Save the results per air plane. The previous location is the one preceding
+ # the last report which changed the position. If there is none, the previous
+ # location is not changed.
+ #
+  same= numpy.all( q == p, axis=1 )
+  move= list( tail )			# Last report which changed the position
+  for g in numpy.flatnonzero( same[tail] ).tolist():
+    i= tail[g]
+    while i >= 0  and  same[i]:
+      i= prv[i]
+    move[g]= i
+  curs= q[tail].tolist() ;  prvs= p[move].tolist()
+  for g,pln in enumerate( plns ):
+    if move[g] >= 0:
+      loc= prvs[g]
+      pln.PrevLoc= None if loc[0] != loc[0] else tuple( loc )	# NaN: none
+    pln.CurLoc= tuple( curs[g] )
+    dm= dmin[g]
+    pln.Distance= dm if pln.Distance is None else min( pln.Distance, dm )
+    if pasd[g]:  pln.Passed= True
+    if RefPnts:
+      pln.Dists= MinDistances( pln.Dists, kmin[g] )
+    if aev is not None  and  pln.Passed:
+      pln.ConfirmPass()
+
+
+#
+# Class FeedSupervisor keeps the state of the connection to one feed: the
+# socket, if connected, the time of the last data received and the time of the
+# next connection attempt. The number of reconnections and the accumulated
+# downtime are saved in the statistics of the feed in afs. The first feed is
+# the one of the local data collector, which may be (re)started.
+#
+class FeedSupervisor():
+  def __init__( self, host, port, collect ):
+    self.host= host			# Address of feed
+    self.port= port
+    self.name= '{}:{}'.format( host, port )
+    self.collect= collect		# Flag: data collector may be started
+    self.sock= None			# Socket, if connected
+    self.read= None			# Method to read a batch of messages
+    self.process= None			# Method to process a batch
+    self.last = 0			# Time of last data received
+    self.retry= 0			# Time of next connection attempt
+    self.delay= FeedBackoffMin		# Current retry interval
+    self.probe= 0			# End of readiness probing of collector
+    self.connected= False		# Flag: has been connected before
+    self.stats= afs[self.name]= dict( total_messages= 0, dupl_messages= 0,
+                  reconnects= 0, downtime= 0.0, down_since= time.time() )
+
+ #
+ # Method Up registers a successful connection at time now.
+ #
+  def Up( self, now ):
+    st= self.stats
+    if st['down_since'] is not None:
+      st['downtime']+= now - st['down_since']
+      st['down_since']= None
+    if self.connected:
+      st['reconnects']+= 1
+    self.connected= True
+    self.last = now
+    self.delay= FeedBackoffMin
+    self.probe= 0
+
+ #
+ # Method Down registers the loss of the connection at time now. The first
+ # attempt to reconnect is made immediately.
+ #
+  def Down( self, now ):
+    self.sock= None
+    self.stats['down_since']= now
+    self.retry= now
+
+ #
+ # Method Failed registers a failed connection attempt at time now and
+ # schedules the next one. While the data collector is starting, its port is
+ # probed at a fixed, short interval.
+ #
+  def Failed( self, now ):
+    if now < self.probe:
+      self.retry= now + ProbeInterval
+    else:
+      self.retry= now + self.delay
+      self.delay= min( 2*self.delay, FeedBackoffMax )
+
+#
+# Function FeedDowntime returns the accumulated downtime of a feed with
+# statistics st, including the current period of downtime, if any.
+#
+def FeedDowntime( st, now ):
+  down= st['downtime']
+  if st['down_since'] is not None:
+    down+= now - st['down_since']
+  return down
+
+
+#
+# Class HandleMessages receives the messages from the ADS-B data collector. It
+# creates an Airplane object for each air plane detected and it invokes methods
+# of this object to extract the relevant information. In the threaded daemon,
+# the sockets are read by this thread, which passes the messages via a ring
+# buffer to thread ProcessMessages.
+#
+class HandleMessages( StoppableThread ):
+  def __init__( self ):
+    super().__init__()			# Parent initialisation
+    self.name= 'HandleMessages'		# Name of thread
+    self.feeds= []			# Supervisors of the feeds
+    self.collector= None		# Data collector process, if started
+    self.ready= threading.Event()	# Set once a feed is connected
+    self.dedup= None			# Duplicate detector of multiple feeds
+    self.decoder= ModeSDecoder()	# Decoder of Beast input
+    self.cleaner= None			# Expiry handler in replay mode
+    self.due= -math.inf			# Next expiry time in replay mode
+    self.ring= MessageRing( RingSize )	# Messages to be processed
+    self.sampled= None			# Time of previous sample of the metrics
+    self.counted= 0			# Total messages at previous sample
+
+ #
+ # Private method _open tries to connect to feed feed at time now. If the
+ # connection is refused by the local data collector, and if the collector is
+ # not running, it is started. The socket is returned, or None if the attempt
+ # failed.
+ #
+  def _open( self, feed, now ):
+    sock= socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    sock.settimeout( ConnectTimeout )
+    try:
+      sock.connect( (feed.host,feed.port) )
+    except OSError as e:
+      sock.close()
+      if feed.collect  and  isinstance( e, ConnectionRefusedError ):
+        if now >= feed.probe  and  not self._collector_running():
+          self._start_collector()
+          feed.probe= now + ReadyTimeout
+      feed.Failed( now )
+      self.LogError( 'connect', 'Error: connect to {} failed: {}'.format(feed.name,e) )
+      return None
+    sock.settimeout( None )
+
+    feed.sock= sock
+    if Input == 'beast':
+      feed.read,feed.process= BeastReader(sock).ReadFrames, self.ProcessFrames
+    else:
+      feed.read,feed.process= LineReader(sock).ReadLines, self.ProcessLines
+    feed.Up( now )
+    self.LogMessage( 'Connected to {}'.format(feed.name) )
+    self.ready.set()
+    return sock
+
+ #
+ # Private methods _collector_running and _start_collector check for and start
+ # the data collector, dump1090, as an independent process. The readiness of the
+ # collector is determined by probing its port.
+ #
+  def _collector_running( self ):
+    return self.collector is not None  and  self.collector.poll() is None
+
+  def _start_collector( self ):
+    DevNull= subprocess.DEVNULL		# Destination for output
+    cmd= ExtColBeast if Input == 'beast' else ExtCol
+    try:
+      self.collector= subprocess.Popen( cmd, stdout=DevNull, stderr=DevNull )
+    except OSError as e:
+      self.LogError( 'collector', 'Error: starting data collector failed: {}'.format(e) )
+      return None
+    self.LogMessage( 'Started data collector, pid {}'.format(self.collector.pid) )
+    return self.collector.pid
+
+ #
+ # Method ProcessLines handles a list of BaseStation messages. If now is
+ # specified, it is the time of reception of all messages in the list.
+ # Otherwise, in replay mode, the time stamp is taken from each message and the
+ # air planes which have expired are removed by CleanAirplaneList object
+ # self.cleaner. If feed is specified, it is the name of the feed from which
+ # the messages are received.
+ #
+  def ProcessLines( self, lines, now=None, feed=None ):
+    t0= time.perf_counter()
+    cnt= ams.Local()			# Counters of this thread
+    if feed is not None:
+      afs[feed]['total_messages']+= len( lines )
+    dedup= self.dedup  if feed is not None  else None
+    if dedup is not None:
+      dedup.Purge( now )
+    recs= [] ;  stamps= None if now is not None else []
+    for line in lines:
+      if line == '':  continue
+
+      cnt['total_messages']+= 1
+ #
+ # Check the shape of the line and extract the fields needed for its
+ # transmission type. Messages of the other transmission types are reduced to
+ # the ICAO address.
+ #
+      try:
+        rec= ParseSbs( line )
+      except ValueError as e:
+        self.LogError( 'format', str(e) )
+        cnt['erred_messages']+= 1
+        continue
+ #
+ # Address 000000(16) is ignored, as the decoding of the address is probably
+ # incomplete and as those messages do not give any additional information,
+ # relevant to this script.
+ #
+      if rec[0] == '000000':
+        cnt['zero_id_messages']+= 1
+        continue
+ #
+ # In replay mode, determine the time at which the message was generated. Before
+ # handling the message, remove the air planes which have expired at that time.
+ # The pending records are handled first, as they may belong to one of those air
+ # planes. An air plane entered after an expiry pass at time uts expires no
+ # earlier than PlaneTimeout seconds later, thus the next pass is due at that
+ # time at the latest.
+ #
+      if now is None:
+        try:
+          uts= DecodeDateTime( *line.split( ',', 8 )[6:8] )
+        except ValueError:
+          self.LogError( 'time', 'Unexpected time stamp in "{}"'.format(line) )
+          cnt['erred_messages']+= 1
+          continue
+        if uts >= self.due:
+          self.ProcessRecords( recs, None, stamps )
+          recs= [] ;  stamps= []
+          self.due= min( self.cleaner.ExpirePlanes( uts ), uts + PlaneTimeout )
+      else:
+        uts= now
+ #
+ # If multiple feeds are combined, discard a message which has already been
+ # received from another feed. The key consists of the ICAO address, the
+ # transmission type and the contents, thus excluding the time stamps.
+ #
+      if dedup is not None:
+        flds= line.split( ',', 10 )
+        if dedup.IsDuplicate( (flds[4],flds[1],flds[10]), feed, uts ):
+          cnt['dupl_messages']+= 1
+          afs[feed]['dupl_messages']+= 1
+          continue
+
+      recs.append( rec )
+      if stamps is not None:
+        stamps.append( uts )
+
+    amx['batch_size'].Observe( len(lines) )
+    amx['parse_time'].Observe( time.perf_counter() - t0 )
+    self.ProcessRecords( recs, now, stamps )
+
+ #
+ # Method ProcessFrames handles a list of long Mode S messages, received at time
+ # now in Beast format from feed feed. The ADS-B messages are decoded and the
+ # results are handled by method ProcessRecords.
+ #
+  def ProcessFrames( self, msgs, now, feed=None ):
+    t0= time.perf_counter()
+    cnt= ams.Local()			# Counters of this thread
+    cnt['total_messages']+= len( msgs )
+    if feed is not None:
+      afs[feed]['total_messages']+= len( msgs )
+    dedup= self.dedup  if feed is not None  else None
+    if dedup is not None:
+      dedup.Purge( now )
+    recs= []
+    for msg in msgs:
+      if dedup is not None  and  dedup.IsDuplicate( msg, feed, now ):
+        cnt['dupl_messages']+= 1
+        afs[feed]['dupl_messages']+= 1
+        continue
+      rec= self.decoder.Decode( msg, now )
+      if rec is None:  continue		# Not an ADS-B message
+      if rec[0] == '000000':
+        cnt['zero_id_messages']+= 1
+        continue
+      recs.append( rec )
+    amx['batch_size'].Observe( len(msgs) )
+    amx['parse_time'].Observe( time.perf_counter() - t0 )
+    self.ProcessRecords( recs, now )
+
+ #
+ # Method ProcessRecords handles a list of decoded messages, received at time
+ # now. Each message is a tuple (id,tt,...), in which id is the ICAO address and
+ # tt the BaseStation transmission type. Only types 1 (call sign) and 3
+ # (position) carry parameters. In replay mode, now is None and list stamps
+ # contains the time of each message. A message of an address which is not in
+ # the air plane list is passed to the admission filter. Once the address is
+ # admitted, the messages held by the filter are handled first.
+ #
+  def ProcessRecords( self, recs, now, stamps=None ):
+    cnt= ams.Local()			# Counters of this thread
+    bpl= [] ;  blat= [] ;  blon= [] ;  balt= []	# Position reports
+    for k,rec in enumerate( recs ):
+      id= rec[0]
+      uts= now if stamps is None else stamps[k]
+      ap= apl.get( id )
+      if ap is None:
+        held= apa.Admit( rec, uts )
+        if held is None:  continue	# Address is on probation
+        ap= EnterAirplane( id )		# Enter airplane in list
+        if held:
+          self.ProcessRecords( [r for (r,t) in held], None, [t for (r,t) in held] )
+      ap.SetLastSeen( uts )
+      ap.TotalMsg+= 1			# Increment total message count
+      tt= rec[1]
+      if   tt == 1:
+        ap.SetCallSign( rec[2] )	# Save call sign
+        cnt['procd_messages']+= 1	# Update processed message count
+      elif tt == 3:
+        bpl.append( ap )		# Save position for batch processing
+        blat.append( rec[2] ) ;  blon.append( rec[3] ) ;  balt.append( rec[4] )
+        ap.LocatMsg+= 1			# Update number of position messages
+        cnt['procd_messages']+= 1	# Update processed message count
+    if bpl:
+      t0= time.perf_counter()
+      ExtractDistances( bpl, blat, blon, balt )
+      amx['extract_time'].Observe( time.perf_counter() - t0 )
+
+ #
+ # Method Sample records, at most once per second, the message rate and the
+ # number of octets waiting to be read from each socket in list socks.
+ #
+  def Sample( self, now, socks=() ):
+    if self.sampled is not None  and  now - self.sampled < 1:  return
+    total= ams['total_messages']
+    if self.sampled is not None:
+      amx['message_rate'].Observe( (total - self.counted)/(now - self.sampled) )
+    self.sampled= now ;  self.counted= total
+    for sock in socks:
+      try:
+        size= fcntl.ioctl( sock, termios.FIONREAD, b'\0\0\0\0' )
+        amx['backlog'].Observe( struct.unpack( 'i', size )[0] )
+      except OSError:
+        pass
+
+  def run(self):
+    self.LogMessage( 'Starting thread' )
+
+ #
+ # Connect to each of the feeds, and wait for messages to arrive on any of them.
+ # A feed of which the connection is lost is reconnected, while the other feeds
+ # are still read.
+ #
+    feeds= Feeds or [ (ServerHost,BeastPort if Input == 'beast' else ServerPort) ]
+    if len(feeds) > 1:
+      self.dedup= Deduplicator( DedupWindow )
+    self.feeds= [ FeedSupervisor( host, port, i == 0 )
+                  for i,(host,port) in enumerate( feeds ) ]
+    sel= selectors.DefaultSelector()
+    cnt= ams.Local()			# Counters of this thread
+    worker= ProcessMessages( self )
+    worker.start()
+
+    while not self.stopped():
+ #
+ # If the processing thread has died, the messages would only fill the ring
+ # buffer. Stop this thread as well, thus the main thread stops the script.
+ #
+      if not worker.is_alive():
+        self.LogMessage( 'Error: thread {} has died'.format(worker.name) )
+        break
+      now= time.time()
+      for feed in self.feeds:
+        if feed.sock is None  and  now >= feed.retry:
+          if self._open( feed, now ) is not None:
+            sel.register( feed.sock, selectors.EVENT_READ, feed )
+      wake= min( [ f.retry for f in self.feeds if f.sock is None ], default=now+1 )
+      events= sel.select( min( max(wake-time.time(),0), 1.0 ) )
+      now= time.time()
+      for key,mask in events:
+        feed= key.data
+        try:
+          items= feed.read()
+        except OSError as e:
+          self._lost( feed, sel, now, '{}, feed'.format(e) )
+          continue
+        if items is None:
+          self._lost( feed, sel, now, 'connection closed by' )
+          continue
+        feed.last= now
+        if items  and  not self.ring.Put( (feed.process,items,now,feed.name), len(items) ):
+          cnt['drop_messages']+= len( items )
+ #
+ # A feed which has not sent any data for a long time is reconnected. If the
+ # data collector has died meanwhile, it will be restarted.
+ #
+      for feed in self.feeds:
+        if feed.sock is not None  and  now - feed.last > StallTime:
+          self._lost( feed, sel, now, 'no data received from' )
+      self.Sample( now, [ f.sock for f in self.feeds if f.sock is not None ] )
+
+    for feed in self.feeds:
+      if feed.sock is not None:
+        feed.sock.close()
+    sel.close()
+    self.ring.Close()			# Process remaining messages, then stop
+    worker.join()
+    self.LogMessage( 'Stopping thread' )
+
+ #
+ # Private method _lost closes the connection to feed feed, of which the
+ # connection is lost at time now for reason why.
+ #
+  def _lost( self, feed, sel, now, why ):
+    self.LogMessage( 'Error: {} {}'.format(why,feed.name) )
+    sel.unregister( feed.sock )
+    feed.sock.close()
+    feed.Down( now )
+
+#
+# Thread ProcessMessages drains the ring buffer of HandleMessages object hm in
+# batches and processes the messages. It stops once the ring buffer is closed
+# and empty. It is supervised by thread HandleMessages, which stops if this
+# thread dies.
+#
+class ProcessMessages( StoppableThread ):
+  def __init__( self, hm ):
+    super().__init__()			# Parent initialisation
+    self.name= 'ProcessMessages'	# Name of thread
+    self.hm= hm				# Owner of the ring buffer
+
+  def run( self ):
+    self.LogMessage( 'Starting thread' )
+    while True:
+      batches= self.hm.ring.Get( 1.0 )
+      for (process,items,now,feed) in batches:
+        process( items, now, feed )
+      self.hm.FlushErrors()
+      if not batches  and  self.hm.ring.closed:  break
+    self.LogMessage( 'Stopping thread' )
+
+#
+# Thread CleanAirplaneList removes those air planes which have not been seen
+# since at least PlaneTimeout seconds. The statistics are then updated and a
+# line is written to the logfile. The expiry index is used to determine which
+# air planes might have expired, and to sleep until the next one is due.
+#
+class CleanAirplaneList( StoppableThread ):
+  def __init__( self ):
+    super().__init__()			# Parent initialisation
+    self.name= 'CleanAirplaneList'	# Name of thread
+    self.outfil= None
+    self.archive= None			# PlaneArchive object, if any
+    self.snapdue= time.time() + SnapInterval	# Time of next snapshot
+
+ #
+ # Methods Open and Close open and close the log file and the archive. At
+ # opening, the start time of the data acquisition is written to the log file.
+ #
+  def Open( self, uts ):
+    self.outfil= open( PlaneLog, 'a' )
+    tf= EncodeDateTime( uts )
+    self.outfil.write( '{} Start data acquisition\n'.format(tf) )
+    if ArchiveDir is not None:
+      self.archive= PlaneArchive( ArchiveDir )
+
+  def Close( self ):
+    self.outfil.close()
+    if self.archive is not None:
+      self.archive.Close()
+
+ #
+ # Method ExpirePlanes removes the air planes which have expired at time now,
+ # updates the statistics and records the air planes using method Passed, in
+ # order of the time they were last seen. The air planes evicted from a full
+ # list since the previous pass are recorded in the same way. It returns the
+ # time at which the next air plane may expire, which is infinite if there are
+ # no air planes.
+ #
+  def ExpirePlanes( self, now ):
+    t0= time.perf_counter()
+    cnt= aps.Local()			# Counters of this thread
+    amx['airplanes'].Observe( len(apl) )
+    gone= []				# Expired air planes
+    for id in apx.Expire( now ):
+      ap= apl.get( id )			# Another thread may have evicted
+      if ap is None:  continue		# Already removed
+      if now - ap.LastSeen < PlaneTimeout:  continue
+      if apl.pop( id, None ) is not None:	# Delete the entry
+        gone.append( ap )
+    while apv:
+      gone.append( apv.popleft() )
+    gone.sort( key=PassedOrder )
+
+    for ap in gone:
+      cnt['total_airplane']+= 1
+      sd= ap.Distance			# Shortest distance
+      dc= ClassifyDistance( sd )	# Distance class
+      cnt[dc]+= 1
+      adr.Add( ap.LastSeen, sd )	# Update distance rollups
+      ds= ap.Dists			# Distances to points in RefPnts
+      for k,pnt in enumerate( RefPnts ):
+        st= app[pnt['Name']]
+        st['total_airplane']+= 1
+        st[ClassifyDistance( None if ds is None else float(ds[k]) )]+= 1
+      self.Passed( ap )
+
+    if self.archive is not None:
+      self.archive.Flush()
+    due= apx.Due()			# Time at which next plane may expire
+    amx['expire_time'].Observe( time.perf_counter() - t0 )
+    return math.inf if due is None else due
+
+ #
+ # Method Passed adds air plane ap, which has passed by, to the archive, if any,
+ # and writes its details to the log file if its distance is known.
+ #
+  def Passed( self, ap ):
+    if self.archive is not None:
+      self.archive.Append( ap.FrstSeen, ap.LastSeen, ap.IcaoAddr,
+                           ap.CallSign, ap.LocatMsg, ap.Distance )
+
+    if ap.Distance is not None:
+      tf= EncodeDateTime( ap.FrstSeen )
+      tl= EncodeDateTime( ap.LastSeen )
+      self.outfil.write( '{} {} {}\n'.format(tf,tl,FormatPlane(ap)) )
+      if aev is not None:
+        aev.Publish( 'final', ap )
+
+ #
+ # Method SaveState saves the state of this script in file Snapshot, if defined.
+ # Method Checkpoint does so once every SnapInterval seconds, and returns the
+ # time at which the next snapshot is due.
+ #
+  def SaveState( self ):
+    if Snapshot is None:  return
+    try:
+      SaveSnapshot( Snapshot )
+    except OSError as e:
+      self.LogError( 'snapshot', 'Saving snapshot failed: {}'.format(e) )
+
+  def Checkpoint( self, now ):
+    if Snapshot is None:  return math.inf
+    if now >= self.snapdue:
+      self.SaveState()
+      self.snapdue= now + SnapInterval
+    return self.snapdue
+
+  def run( self ):
+    self.LogMessage( 'Starting thread' )
+    self.Open( sosts )
+
+    while not self.stopped():
+      now= time.time()
+      due= min( self.ExpirePlanes( now ), self.Checkpoint( now ) )
+      self.wait( min(max(due-time.time(),0),PlaneTimeout) )
+
+    self.Close()
+    self.LogMessage( 'Stopping thread' )
+
+
+#
+# Class SamplingProfiler samples at regular intervals the function which is
+# executed by each of the other threads. Counting these functions shows where
+# the CPU time is spent, at a much lower overhead than a deterministic profiler.
+# It is started and stopped using a query.
+#
+class SamplingProfiler( StoppableThread ):
+  def __init__( self ):
+    super().__init__()			# Parent initialisation
+    self.name= 'SamplingProfiler'	# Name of thread
+    self.counts= collections.Counter()	# Samples per thread and function
+    self.samples= 0			# Number of samples taken
+    self.names= {}			# Thread name per thread identifier
+
+  def Report( self, top ):
+    lines= [ '{} samples at {} [s] interval'.format(self.samples,ProfInterval) ]
+    for ((tid,func),n) in self.counts.most_common( top ):
+      pct= 100.0*n/self.samples if self.samples > 0 else 0
+      lines.append( '{:6.2f}% {:16} {}'.format(pct,self.names.get(tid,tid),func) )
+    return '\n'.join( lines ) + '\n'
+
+  def run( self ):
+    self.LogMessage( 'Starting thread' )
+    me= threading.get_ident()
+    while not self.wait( ProfInterval ):
+      for tid,frame in sys._current_frames().items():
+        if tid == me:  continue
+        if tid not in self.names:
+          self.names.update( (t.ident,t.name) for t in threading.enumerate() )
+        code= frame.f_code
+        self.counts[(tid,'{}:{} {}'.format(os.path.basename(code.co_filename),
+                      frame.f_lineno,code.co_name))]+= 1
+      self.samples+= 1
+    self.LogMessage( 'Stopping thread' )
+
+
+#
+# Class QueryServer answers local queries on Unix domain socket QuerySocket.
+# A query is one line, containing a command followed by its parameters. The
+# answer is written as text, after which the connection is closed. Command
+# 'rollup RES [COUNT]' returns the most recent COUNT rows of the distance
+# histogram with resolution RES seconds. Command 'metrics' returns the hot path
+# metrics and command 'profile start|stop|report' controls the sampling
+# profiler.
+#
+class QueryServer( StoppableThread ):
+  def __init__( self, ring=None ):
+    super().__init__()			# Parent initialisation
+    self.name= 'QueryServer'		# Name of thread
+    self.ring= ring			# Ring buffer of HandleMessages, if any
+    self.commands= dict( rollup= self._rollup, metrics= self._metrics,
+                         profile= self._profile, prometheus= self._prometheus )
+    self.profiler= None			# Sampling profiler, if started
+
+  def _rollup( self, args ):
+    res  = int( args[0] )
+    count= int( args[1] ) if len(args) > 1 else None
+    if res not in adr.res:
+      raise ValueError( 'resolution should be one of {}'.format(adr.res) )
+    lines= [ ' '.join( ['period'] + adr.Labels() ) ]
+    for (uts,cnts) in adr.Rows( res, count ):
+      lines.append( ' '.join( [EncodeDateTime(uts)] + [ str(c) for c in cnts ] ) )
+    return '\n'.join( lines ) + '\n'
+
+  def _metrics( self, args ):
+    lines= [ '{:16} {}'.format('airplanes_now',len(apl)) ]
+    if self.ring is not None:
+      lines.append( '{:16} {}'.format('ring_now',self.ring.depth) )
+      lines.append( '{:16} {}'.format('ring_hwm',self.ring.hwm) )
+    for key,val in ams.items():
+      lines.append( '{:16} {}'.format(key,val) )
+    now= time.time()
+    for feed in sorted( afs ):
+      lines.append( '{:16} {} reconnects {} downtime {:.0f}'.format( 'feed', feed,
+                    afs[feed]['reconnects'], FeedDowntime(afs[feed],now) ) )
+    lines.append( '{:16} {:>9} {:>11} {:>11} {:>11} {:>11} {:>11}'.format(
+                  'metric','count','mean','p50','p90','p99','max') )
+    for key in amx:
+      lines.append( amx[key].Format( key ) )
+    return '\n'.join( lines ) + '\n'
+
+  def _prometheus( self, args ):
+    return FormatPrometheus( MetricsSnapshot() )
+
+  def _profile( self, args ):
+    action= args[0] if args else 'report'
+    if action == 'start':
+      if self.profiler is None:
+        self.profiler= SamplingProfiler()
+        self.profiler.start()
+      return 'Profiler started\n'
+    if self.profiler is None:
+      return 'Error: profiler is not started\n'
+    if action == 'report':
+      return self.profiler.Report( ProfTop )
+    if action == 'stop':
+      self.profiler.stop()
+      self.profiler.join()
+      report= self.profiler.Report( ProfTop )
+      self.profiler= None
+      return report
+    raise ValueError( 'action should be one of start, stop, report' )
+
+ #
+ # Method Answer executes one query and returns the answer.
+ #
+  def Answer( self, query ):
+    args= query.split()
+    if not args  or  args[0] not in self.commands:
+      return 'Error: unknown command, use one of {}\n'.format( ' '.join(sorted(self.commands)) )
+    try:
+      return self.commands[args[0]]( args[1:] )
+    except (ValueError,IndexError) as e:
+      return 'Error: {}\n'.format( e )
+
+  def run( self ):
+    self.LogMessage( 'Starting thread' )
+    if os.path.exists( QuerySocket ):  os.remove( QuerySocket )
+    srv= socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    srv.bind( QuerySocket )
+    srv.listen( 4 )
+    srv.settimeout( 1.0 )		# Check regularly for stop
+    while not self.stopped():
+      try:
+        conn,addr= srv.accept()
+      except socket.timeout:
+        continue
+      with conn:
+        conn.settimeout( 5.0 )
+        try:
+          query= conn.makefile( 'r' ).readline()
+          conn.sendall( self.Answer(query).encode() )
+        except OSError:
+          pass
+    if self.profiler is not None:
+      self.profiler.stop()
+    srv.close()
+    os.remove( QuerySocket )
+    self.LogMessage( 'Stopping thread' )
+
+
+#
+# Class EventHub distributes the events of passing air planes to the
+# subscribers. Each subscriber is represented by a bounded queue, either a
+# queue.Queue or an asyncio.Queue, to which the event is added without waiting.
+# If the queue of a subscriber is full, the event is dropped for that
+# subscriber only. The tuple of subscribers is replaced rather than modified,
+# thus it can be scanned without a lock.
+#
+class EventHub():
+  def __init__( self ):
+    self.subs= ()			# Queues of subscribers
+    self.lock= threading.Lock()		# Serialise changes of subs
+
+  def Subscribe( self, q ):
+    with self.lock:
+      if len(self.subs) >= EventClients:  return False
+      self.subs= self.subs + (q,)
+    return True
+
+  def Unsubscribe( self, q ):
+    with self.lock:
+      self.subs= tuple( s for s in self.subs if s is not q )
+
+ #
+ # Method Publish sends an event of kind kind about air plane ap. An event is one
+ # line, containing the time the air plane was last seen, the kind of event and
+ # the fields of the log of passed air planes, see function FormatPlane.
+ #
+  def Publish( self, kind, ap ):
+    cnt= aps.Local()			# Counters of this thread
+    cnt['published_events']+= 1
+    subs= self.subs
+    if not subs:  return
+    line= '{} {:6} {}\n'.format( EncodeDateTime(ap.LastSeen), kind, FormatPlane(ap) ).encode()
+    for q in subs:
+      try:
+        q.put_nowait( line )
+      except (queue.Full,asyncio.QueueFull):
+        cnt['dropped_events']+= 1
+
+#
+# Function EventListener creates the listening socket for the subscribers of the
+# events, as defined by EventSocket.
+#
+def EventListener():
+  if isinstance( EventSocket, str ):
+    if os.path.exists( EventSocket ):  os.remove( EventSocket )
+    srv= socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    srv.bind( EventSocket )
+  else:
+    srv= socket.create_server( EventSocket )
+  srv.listen( EventClients )
+  return srv
+
+#
+# Class EventStream sends the events queued for one subscriber, connected via
+# socket conn. A subscriber which cannot be written to within EventTimeout
+# seconds is disconnected, which affects neither the other subscribers nor the
+# processing of messages.
+#
+class EventStream( StoppableThread ):
+  def __init__( self, conn ):
+    super().__init__()			# Parent initialisation
+    self.name= 'EventStream'		# Name of thread
+    self.conn= conn			# Socket of subscriber
+    self.queue= queue.Queue( EventQueue )	# Events to send
+
+  def run( self ):
+    self.conn.settimeout( EventTimeout )
+    try:
+      while not self.stopped():
+        try:
+          line= self.queue.get( timeout=1 )
+        except queue.Empty:
+          continue
+        self.conn.sendall( line )
+    except OSError:
+      pass				# Subscriber is gone or stuck
+    finally:
+      aev.Unsubscribe( self.queue )
+      self.conn.close()
+
+#
+# Class EventServer accepts the subscribers to the events on socket EventSocket
+# and starts an EventStream thread for each of them. At most EventClients
+# subscribers are served at the same time.
+#
+class EventServer( StoppableThread ):
+  def __init__( self ):
+    super().__init__()			# Parent initialisation
+    self.name= 'EventServer'		# Name of thread
+    self.streams= []			# EventStream threads
+
+  def run( self ):
+    self.LogMessage( 'Starting thread' )
+    srv= EventListener()
+    srv.settimeout( 1.0 )		# Check regularly for stop
+    while not self.stopped():
+      try:
+        conn,addr= srv.accept()
+      except socket.timeout:
+        continue
+      self.streams= [ t for t in self.streams if t.is_alive() ]
+      es= EventStream( conn )
+      if not aev.Subscribe( es.queue ):
+        conn.close()
+        continue
+      self.streams.append( es )
+      es.start()
+    for t in self.streams:
+      t.stop()
+    for t in self.streams:
+      t.join()
+    srv.close()
+    if isinstance( EventSocket, str ):  os.remove( EventSocket )
+    self.LogMessage( 'Stopping thread' )
+
+
+#
+# Class XymonSender sends the status messages to the Xymon server. The messages
+# are passed via a bounded queue, thus the thread building the messages is never
+# blocked by the network. Messages which cannot be delivered are saved in a
+# spool file, which is emptied as soon as the Xymon server is reachable again.
+#
+class XymonSender( StoppableThread ):
+  def __init__( self ):
+    super().__init__()			# Parent initialisation
+    self.name= 'XymonSender'		# Name of thread
+    self.queue= queue.Queue( XyQueueSize )	# Outbound messages
+    self.addr= None			# Cached address of Xymon server
+    self.expires= 0			# Expiry time of cached address
+    self.spooled= len( self._read_spool() )	# Number of spooled messages
+
+ #
+ # Method Combine builds one combo message from a list of status messages.
+ #
+  def Combine( self, msgs ):
+    return 'combo\n' + '\n\n'.join( msgs )
+
+ #
+ # Method Submit queues a list of status messages, combined into one combo
+ # message, for sending. If the queue is full, the message is discarded.
+ #
+  def Submit( self, msgs ):
+    try:
+      self.queue.put_nowait( self.Combine(msgs) )
+    except queue.Full:
+      self.LogMessage( 'Xymon queue is full, message discarded' )
+
+ #
+ # Private method _resolve returns the IP address of the Xymon server. The
+ # address is cached for XyDnsTtl seconds.
+ #
+  def _resolve( self ):
+    if re.search( '^[\d\.]+$', self.XyServ ):
+      return self.XyServ
+    if self.addr is None  or  time.time() > self.expires:
+      self.addr= socket.gethostbyname( self.XyServ )
+      self.expires= time.time() + XyDnsTtl
+    return self.addr
+
+ #
+ # Private method _send sends one message to the Xymon server. It returns True
+ # if successful, False otherwise.
+ #
+  def _send( self, msg ):
+    t0= time.perf_counter()
+    try:
+      with socket.create_connection( (self._resolve(),self.XyPort), XyTimeout ) as s:
+        s.sendall( msg.encode() )
+      amx['xymon_time'].Observe( time.perf_counter() - t0 )
+      return True
+    except (OSError,socket.gaierror):
+      self.addr= None			# Resolve again at next attempt
+      return False
+
+ #
+ # Private methods _read_spool and _write_spool read and (re)write the spool
+ # file. Each message is preceded by a line containing its length in octets. The
+ # spool file is replaced atomically.
+ #
+  def _read_spool( self ):
+    msgs= []
+    try:
+      with open( XySpool, 'rb' ) as f:
+        while True:
+          size= f.readline()
+          if not size:  break
+          msgs.append( f.read( int(size) ).decode() )
+    except (OSError,ValueError):
+      pass
+    return msgs
+
+  def _write_spool( self, msgs ):
+    try:
+      if msgs:
+        with open( XySpool + '.tmp', 'wb' ) as f:
+          for msg in msgs:
+            data= msg.encode()
+            f.write( '{}\n'.format(len(data)).encode() + data )
+        os.replace( XySpool + '.tmp', XySpool )
+      elif os.path.exists( XySpool ):
+        os.remove( XySpool )
+    except OSError:
+      self.LogMessage( 'Error: cannot write spool file {}'.format(XySpool) )
+    self.spooled= len( msgs )
+
+ #
+ # Method Newest reduces a list of combo messages, oldest first, to one combo
+ # message containing the newest status message of each host and test.
+ #
+  def Newest( self, msgs ):
+    stats= {}				# Status message per host.test
+    for msg in msgs:
+      if msg.startswith( 'combo\n' ):  msg= msg[6:]
+      for st in re.split( r'\n\n(?=status \S+ \S+ )', msg ):
+        stats[st.split( None, 2 )[1]]= st
+    return self.Combine( list( stats.values() ) )
+
+ #
+ # Method Deliver sends the spooled messages, followed by message msg if it is
+ # not None. If there is more than one, they are reduced to the newest status
+ # of each test first. The message which could not be sent is spooled. It
+ # returns True if all messages are delivered.
+ #
+  def Deliver( self, msg ):
+    msgs= self._read_spool() if self.spooled > 0 else []
+    if msg is not None:  msgs.append( msg )
+    if len(msgs) > 1:
+      msgs= [ self.Newest( msgs ) ]
+    sent= 0
+    for m in msgs:
+      if not self._send( m ):  break
+      sent+= 1
+    if sent < len(msgs)  or  self.spooled > 0:
+      self._write_spool( msgs[sent:] )
+    if sent < len(msgs):
+      self.LogMessage( 'Sending Xymon message failed, {} message(s) spooled'.format(self.spooled) )
+    return sent == len(msgs)
+
+  def run( self ):
+    self.LogMessage( 'Starting thread' )
+    retry= 0.0				# Time of next retry of spooled messages
+    delay= XyBackoffMin			# Retry interval
+    while not self.stopped():
+      try:
+        msg= self.queue.get( timeout=1 )
+      except queue.Empty:
+        msg= None
+      if msg is None  and  ( self.spooled == 0  or  time.time() < retry ):
+        continue
+      if self.Deliver( msg ):
+        delay= XyBackoffMin
+      else:
+        retry= time.time() + delay
+        delay= min( 2*delay, XyBackoffMax )
+ #
+ # Try to deliver the messages still in the queue once. If that fails, they are
+ # spooled.
+ #
+    while not self.queue.empty():
+      self.Deliver( self.queue.get_nowait() )
+    self.LogMessage( 'Stopping thread' )
+
+
+#
+# Class MetricsSnapshot captures the statistics collected by the threads
+# HandleMessages and CleanAirplaneList, together with the current number of air
+# planes per distance class, at one moment. All reports built from one snapshot
+# are consistent. Counters ams and aps are copied per thread in one step, and
+# the air plane list is copied in one step as well, thus the snapshot is cheap
+# and does not block the other threads.
+#
+class MetricsSnapshot():
+  def __init__( self ):
+    self.time= time.time()		# Time of snapshot
+    self.ams = ams.Copy()		# Message statistics
+    self.aps = aps.Copy()		# Air plane statistics
+    self.app = { name: st.copy() for (name,st) in list( app.items() ) }
+    self.afs = { feed: st.copy() for (feed,st) in list( afs.items() ) }
+    planes= list( apl.values() )	# Air planes being tracked
+    self.cur = CountDistances( [ ap.Distance for ap in planes ] )
+    self.cur['total_airplane']= len( planes )
+    self.cpp = {}			# Current counts per point in RefPnts
+    dists= [ ap.Dists for ap in planes ]
+    for k,pnt in enumerate( RefPnts ):
+      cnt= CountDistances( [ None if ds is None else ds[k] for ds in dists ] )
+      cnt['total_airplane']= len( planes )
+      self.cpp[pnt['Name']]= cnt
+
+ #
+ # Method Samples returns the statistics as a list of tuples (name,labels,value),
+ # in which labels is a tuple of (label,value) pairs. The kind and description
+ # of each name are found in MetricHelp. The samples of one name are adjacent.
+ #
+  def Samples( self ):
+    keys= DistKeys + [DistUnkn]		# Report order of distance classes
+    pnts= [ ('reference',self.aps,self.cur) ] + \
+          [ (p['Name'],self.app[p['Name']],self.cpp[p['Name']]) for p in RefPnts ]
+    smp = [ ('start_time_seconds',(),sosts or 0) ]
+    smp+= [ ('messages_total',(('kind',key.replace('_messages','')),),val)
+            for (key,val) in self.ams.items() ]
+    smp+= [ ('airplanes_passed_total',(('point',name),),st['total_airplane'])
+            for (name,st,cur) in pnts ]
+    smp+= [ ('airplanes_total',(('point',name),('class',key)),st[key])
+            for (name,st,cur) in pnts for key in keys ]
+    smp+= [ ('airplanes_current',(('point',name),('class',key)),cur[key])
+            for (name,st,cur) in pnts for key in keys ]
+    smp+= [ ('airplanes_tracked',(),self.cur['total_airplane']),
+            ('addresses_rejected_total',(),self.aps['rejected_airplane']),
+            ('airplanes_evicted_total',(),self.aps['evicted_airplane']),
+            ('events_published_total',(),self.aps['published_events']),
+            ('events_dropped_total',(),self.aps['dropped_events']) ]
+    feeds= sorted( self.afs )
+    for (name,key) in ( ('feed_messages_total','total_messages'),
+                        ('feed_duplicates_total','dupl_messages'),
+                        ('feed_reconnects_total','reconnects') ):
+      smp+= [ (name,(('feed',feed),),self.afs[feed][key]) for feed in feeds ]
+    smp+= [ ('feed_downtime_seconds_total',(('feed',feed),),
+             round( FeedDowntime( self.afs[feed], self.time ), 3 )) for feed in feeds ]
+    return smp
+
+MetricHelp= dict(
+  start_time_seconds         = ( 'gauge'  , 'Start of the statistics collection' ),
+  messages_total             = ( 'counter', 'ADS-B messages, per kind' ),
+  airplanes_passed_total     = ( 'counter', 'Air planes which have passed by' ),
+  airplanes_total            = ( 'counter', 'Passed air planes, per distance class' ),
+  airplanes_current          = ( 'gauge'  , 'Tracked air planes, per distance class' ),
+  airplanes_tracked          = ( 'gauge'  , 'Air planes being tracked' ),
+  addresses_rejected_total   = ( 'counter', 'ICAO addresses not admitted' ),
+  airplanes_evicted_total    = ( 'counter', 'Air planes evicted from a full list' ),
+  events_published_total     = ( 'counter', 'Pass events published' ),
+  events_dropped_total       = ( 'counter', 'Pass events dropped, summed over subscribers' ),
+  feed_messages_total        = ( 'counter', 'Messages received, per feed' ),
+  feed_duplicates_total      = ( 'counter', 'Duplicate messages, per feed' ),
+  feed_reconnects_total      = ( 'counter', 'Reconnections, per feed' ),
+  feed_downtime_seconds_total= ( 'counter', 'Time without connection, per feed' ),
+)
+
+#
+# Function FormatPrometheus renders MetricsSnapshot snap in the Prometheus text
+# exposition format.
+#
+def FormatPrometheus( snap ):
+  lines= [] ;  prev= None
+  for (name,labels,val) in snap.Samples():
+    name= 'detapd_' + name
+    if name != prev:
+      kind,text= MetricHelp[name[7:]]
+      lines.append( '# HELP {} {}'.format(name,text) )
+      lines.append( '# TYPE {} {}'.format(name,kind) )
+      prev= name
+    if labels:
+      name+= '{' + ','.join( '{}="{}"'.format( k, str(v).replace('\\','\\\\').replace('"','\\"') )
+                             for (k,v) in labels ) + '}'
+    lines.append( '{} {}'.format(name,val) )
+  return '\n'.join( lines ) + '\n'
+
+#
+# Class PrometheusSink writes a MetricsSnapshot to file path in the Prometheus
+# text exposition format. The file is replaced atomically, thus a reader never
+# sees a partial file.
+#
+class PrometheusSink():
+  def __init__( self, path ):
+    self.path= path			# Exposition file
+
+  def Export( self, snap ):
+    with open( self.path + '.tmp', 'w' ) as f:
+      f.write( FormatPrometheus( snap ) )
+    os.replace( self.path + '.tmp', self.path )
+
+#
+# Class StatsdSink sends a MetricsSnapshot to a StatsD server via UDP. A counter
+# is sent as the increment since the previous snapshot, thus the first snapshot
+# only sets the base line of the counters. A gauge is sent as is. The metric
+# name is built from prefix, the name of the sample and its label values.
+#
+class StatsdSink():
+  MaxDatagram= 1400			# Maximum size of a datagram, [B]
+
+  def __init__( self, host, port, prefix ):
+    self.addr  = (host,port)		# Address of StatsD server
+    self.prefix= prefix			# Prefix of metric names
+    self.prev  = None			# Counters of previous snapshot
+    self.sock  = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+
+  def Export( self, snap ):
+    lines= [] ;  cnts= {}
+    for (name,labels,val) in snap.Samples():
+      key= '.'.join( [self.prefix,name] + [ re.sub( '[^\\w-]', '_', str(v) ) for (k,v) in labels ] )
+      if MetricHelp[name][0] == 'gauge':
+        lines.append( '{}:{}|g'.format(key,val) )
+        continue
+      cnts[key]= val
+      if self.prev is not None  and  val != self.prev.get( key, 0 ):
+        lines.append( '{}:{}|c'.format(key,val-self.prev.get(key,0)) )
+    self.prev= cnts
+    buf= ''
+    for line in lines:
+      if buf  and  len(buf) + len(line) >= self.MaxDatagram:
+        self.sock.sendto( buf.encode(), self.addr )
+        buf= ''
+      buf+= ('\n' if buf else '') + line
+    if buf:
+      self.sock.sendto( buf.encode(), self.addr )
+
+
+#
+# Class MonitorAirspace retrieves periodically a snapshot of the statistics
+# collected by classes / threads HandleMessages and CleanAirplaneList, formats
+# it into status messages for the xymon server, and sends them to the server.
+# The same snapshot is exported to the other sinks, if any.
+#
+class MonitorAirspace( StoppableThread ):
+  """Class MonitorAirspace reports some statistics about the air planes in the
+     neighbourhood to the Xymon server."""
+
+  def __init__( self, sender ):
+    super().__init__()
+    self.name= 'MonitorAirspace'
+    self.oldstats= None
+    self.sender= sender			# XymonSender object
+    self.sinks= []			# Other sinks of the statistics
+    if PromFile is not None:
+      self.sinks.append( PrometheusSink( PromFile ) )
+    if StatsdHost is not None:
+      self.sinks.append( StatsdSink( StatsdHost, StatsdPort, StatsdPrefix ) )
+
+  def _message_stats( self, snap ):
+    msg = "<p style='text-align:center'><b>ADS-B statistics</b></p>\n\n"
+    msg+= "<table cellpadding=5>\n"
+    msg+= "  <tr> <th>Key</th> <th>Count []</th> </tr>\n"
+    for key in ('total_messages','procd_messages', 'zero_id_messages','erred_messages','dupl_messages','drop_messages' ):
+      msg+= "  <tr> <td>{}</td> <td>{:8d}</td> </tr>\n".format(key,snap.ams[key])
+    msg+= "</table>\n\n"
+    afs = snap.afs
+    if afs:
+      now = snap.time
+      msg+= "<table cellpadding=5>\n"
+      msg+= "  <tr> <th>Feed</th> <th>Total []</th> <th>Duplicate []</th> <th>Reconnects []</th> <th>Downtime [s]</th> </tr>\n"
+      for feed in sorted(afs):
+        msg+= "  <tr> <td>{}</td> <td>{:8d}</td> <td>{:8d}</td> <td>{:8d}</td> <td>{:10.0f}</td> </tr>\n".format(feed,
+               afs[feed]['total_messages'],afs[feed]['dupl_messages'],
+               afs[feed]['reconnects'],FeedDowntime(afs[feed],now))
+      msg+= "</table>\n\n"
     msg+= "Statistics collection\n"
     msg+= "  started at  {}\n".format( sosrf )
-    scd = (time.time() - sosts)/ 86400	# Duration expressed in days
+    scd = (snap.time - sosts)/ 86400	# Duration expressed in days
     msg+= "  duration is {:10.2f} [d]\n".format( scd )
 
     msg+= "<!-- linecount=1 -->\n"
     msg+= "<!--DEVMON RRD: air 0 0\n"
     msg+= "DS:total:DERIVE:600:0:U DS:erred:DERIVE:600:0:U DS:procd:DERIVE:600:0:U DS:zeroi:DERIVE:600:0:U\n"
+    ams = snap.ams
     msg+= "msg {}:{}:{}:{}\n".format(ams['total_messages'],
            ams['erred_messages'],ams['procd_messages'],ams['zero_id_messages'])
     msg+= "-->\n"
     return msg
 
-  def _airplane_stats( self ):
-    caps= dict( total_airplane= 0 )	# Current air plane statistics
-    for i in DistClass:  caps[i[0]]= 0	# Add counter per distance class
-    for i in list(apl):			# Do NOT use an iterator
-      if i not in apl:  continue	# Another thread may have discarded it
-      dc= ClassifyDistance( apl[i].Distance )
-      caps['total_airplane']+= 1
-      caps[dc]+= 1
-
-    msg = "<p style='text-align:center'><b>Air plane statistics</b></p>\n\n"
+  def _airplane_stats( self, snap, k=None ):
+    if k is None:			# Reference point RefPnt
+      stats= snap.aps ;  caps= snap.cur	# Total and current statistics
+      title= 'Air plane statistics'
+    else:				# Point k of RefPnts
+      stats= snap.app[RefPnts[k]['Name']]
+      caps = snap.cpp[RefPnts[k]['Name']]
+      title= 'Air plane statistics of {}'.format( RefPnts[k]['Name'] )
+    keys= DistKeys + [DistUnkn]		# Report order of distance classes
+    dsnm= dict( (i[0],i[2]) for i in DistClass )	# Data set names
+
+    msg = "<p style='text-align:center'><b>{}</b></p>\n\n".format( title )
     msg+= "<table cellpadding=5>\n"
     msg+= "  <tr> <th>Key</th> <th>Total []</th> <th>Current []</th> </tr>\n"
-    for key in ('total_airplane','dist_00_01_km','dist_01_02_km' ,'dist_02_04_km',
-                'dist_04_08_km' ,'dist_08_16_km','dist_16_inf_km','dist_unknown' ):
-      msg+= "  <tr> <td>{}</td> <td>{:8d}</td> <td>{:8d}</td> </tr>\n".format(key,aps[key],caps[key])
+    for key in ['total_airplane'] + keys:
+      msg+= "  <tr> <td>{}</td> <td>{:8d}</td> <td>{:8d}</td> </tr>\n".format(key,stats[key],caps[key])
     msg+= "</table>\n\n"
+    if k is None:
+      msg+= "Address admission\n"
+      msg+= "  rejected    {:10d}\n".format( stats['rejected_airplane'] )
+      msg+= "  evicted     {:10d}\n".format( stats['evicted_airplane'] )
+      if EventSocket is not None:
+        msg+= "Pass events\n"
+        msg+= "  published   {:10d}\n".format( stats['published_events'] )
+        msg+= "  dropped     {:10d}\n".format( stats['dropped_events'] )
     msg+= "Statistics collection\n"
     msg+= "  started at  {}\n".format( sosrf )
-    scd = (time.time() - sosts)/ 86400	# Duration expressed in days
+    scd = (snap.time - sosts)/ 86400	# Duration expressed in days
     msg+= "  duration is {:10.2f} [d]\n".format( scd )
 
     msg+= "<!-- linecount=1 -->\n"
     msg+= "<!--DEVMON RRD: air 0 0\n"
-    msg+= "DS:d0001:DERIVE:600:0:U DS:d0102:DERIVE:600:0:U DS:d0204:DERIVE:600:0:U "
-    msg+= "DS:d0408:DERIVE:600:0:U DS:d0816:DERIVE:600:0:U DS:d1600:DERIVE:600:0:U "
-    msg+= "DS:dunkn:DERIVE:600:0:U DS:dtotl:DERIVE:600:0:U\n"
-    msg+= "plane {}:{}:{}:{}:{}:{}:{}:{}\n".format(    aps['dist_00_01_km'],
-            aps['dist_01_02_km'],aps['dist_02_04_km'] ,aps['dist_04_08_km'],
-            aps['dist_08_16_km'],aps['dist_16_inf_km'],aps['dist_unknown'] ,
-            aps['total_airplane'] )
+    msg+= ' '.join( 'DS:{}:DERIVE:600:0:U'.format(dsnm[key]) for key in keys )
+    msg+= " DS:dtotl:DERIVE:600:0:U\n"
+    msg+= "plane {}\n".format( ':'.join( str(stats[key]) for key in keys + ['total_airplane'] ) )
     msg+= "-->\n"
     return msg
 
-  def run( self ):
-    self.LogMessage( 'Starting thread' )
+ #
+ # Method BuildReports builds the status messages for the Xymon server from
+ # MetricsSnapshot snap. If snap is None, a snapshot is taken first.
+ #
+  def BuildReports( self, snap=None ):
+    if snap is None:  snap= MetricsSnapshot()
     XyHost= 'Airspace'			# 'Source' of this test
     XyClr = 'green'			# Status (colour) of test
-    while not self.stopped():		# Repeat for a long time
-      Msg= self._message_stats()	# Build status message
-      if not self.InformXymon( XyHost, 'ADS-B', XyClr, Msg ):	# Send it to Xymon
-        self.LogMessage( 'Sending Xymon message failed')
+    msgs= [ self.FormatXymon( XyHost, 'ADS-B'   , XyClr, self._message_stats(snap)  ),
+            self.FormatXymon( XyHost, 'airplane', XyClr, self._airplane_stats(snap) ) ]
+    for k,pnt in enumerate( RefPnts ):
+      msgs.append( self.FormatXymon( XyHost, pnt['Name'], XyClr, self._airplane_stats(snap,k) ) )
+    return msgs
 
-      Msg= self._airplane_stats()	# Build status message
-      if not self.InformXymon( XyHost, 'airplane', XyClr, Msg ):	# Send it to Xymon
-        self.LogMessage( 'Sending Xymon message failed')
+ #
+ # Method Export exports MetricsSnapshot snap to the other sinks. A failing sink
+ # does not affect the others.
+ #
+  def Export( self, snap ):
+    for sink in self.sinks:
+      try:
+        sink.Export( snap )
+      except OSError as e:
+        self.LogError( type(sink).__name__, 'Export to {} failed: {}'.format(type(sink).__name__,e) )
 
+  def run( self ):
+    self.LogMessage( 'Starting thread' )
+    while not self.stopped():		# Repeat for a long time
+      snap= MetricsSnapshot()
+      self.sender.Submit( self.BuildReports(snap) )	# Send them to Xymon
+      self.Export( snap )
       self.Wait( 300, 2 )		# Run once every five minutes
 
     self.LogMessage( 'Stopping thread' )
@@ -569,6 +2957,10 @@ class MonitorAirspace( StoppableThread ):
 #
 MainThread= threading.Event()		# Set to stop this script
 
+#
+# Function HandleSignal handles a termination signal. It stops this script,
+# after which the final snapshot of the state is saved.
+#
 def HandleSignal( signum, frame ):
   syslog.openlog( 'APD', 0, syslog.LOG_LOCAL6 )
   syslog.syslog ( 'Termination signal #{} received'.format(signum) )
@@ -576,47 +2968,676 @@ def HandleSignal( signum, frame ):
   MainThread.set()			# Set flag to stop script
 
 #
-# Set up handling of termination signals. They are converted into an exception.
+# Function Initialise calculates and saves the cartesian coordinates of the
+# reference points, prepares the table of distance classes for a fast lookup
+# and creates the expiry index and the admission filter of the air plane list
+# and the distance rollups.
+#
+def Initialise():
+  global apx, apa, adr, Origin, RefCart, RefVect, RefRel, RefRR, RefReach
+  Origin= RefPnt['Cartesian']= Cartesian( RefPnt['Latitude'], RefPnt['Longitude'], 0 )
+  RefCart= [ Cartesian( p['Latitude'], p['Longitude'], 0 ) for p in RefPnts ]
+  RefReach= max( [ Distance( p, Origin ) for p in RefCart ], default=0 )
+  if numpy is not None:
+    RefRel = numpy.array( RefCart, dtype=float ).reshape( -1, 3 ) - numpy.asarray( Origin )
+    RefRR  = numpy.einsum( 'ij,ij->i', RefRel, RefRel )[:,None]
+    RefVect= len( RefPnts ) >= PointsMin
+    if RefVect:
+      RefCart= numpy.array( RefCart, dtype=float )
+  CompileDistClass( DistClass )
+  for p in RefPnts:
+    app[p['Name']]= dict.fromkeys( ['total_airplane'] + DistKeys + [DistUnkn], 0 )
+  apx= ExpiryIndex( PlaneTimeout )	# Expiry index of air plane list
+  apa= AdmissionFilter( AdmitCount, AdmitWindow )
+  adr= DistanceRollup( RollupRes, RollupRows, RollupStep, RollupBins )
+
+#
+# Function SaveSnapshot saves the statistics, the air plane list and the
+# distance rollups in file path. An unknown location or distance is saved as
+# NaN. The record of each air plane is followed by its distances to the points
+# in RefPnts, if any.
+#
+def SaveSnapshot( path ):
+  cnts= [ ('ams.'+k,v) for k,v in ams.items() ] + \
+        [ ('aps.'+k,v) for k,v in aps.items() ]
+  for name in app:
+    cnts+= [ ('app.{}.{}'.format(name,k),v) for k,v in app[name].items() ]
+  planes= list( apl.values() ) + list( apv )	# Evicted ones expire at restore
+  nan3= (math.nan,)*3
+  ext = struct.Struct( '<{}d'.format(len(RefPnts)) )
+  buf = [ SnapHeader.pack( b'APDS', SnapVersion, sosts or 0,
+                           RefPnt['Latitude'], RefPnt['Longitude'],
+                           len(cnts), len(planes), len(RefPnts) ) ]
+  for (key,val) in cnts:
+    key= key.encode()
+    buf.append( struct.pack( '<B', len(key) ) + key + struct.pack( '<q', val ) )
+  for ap in planes:
+    buf.append( SnapPlane.pack( ap.IcaoAddr.encode( 'ascii', 'replace' ),
+      ( ap.CallSign or '' ).encode( 'ascii', 'replace' ),
+      ap.FrstSeen or 0, ap.LastSeen or 0, ap.LocatMsg, ap.TotalMsg,
+      *( ap.CurLoc or nan3 ), *( ap.PrevLoc or nan3 ),
+      math.nan if ap.Distance is None else ap.Distance, ap.Passed ) )
+    if RefPnts:
+      ds= [math.nan]*len(RefPnts) if ap.Dists is None else ap.Dists
+      buf.append( ext.pack( *ds ) )
+  buf.append( adr.Pack() )
+  with open( path + '.tmp', 'wb' ) as f:
+    f.write( b''.join( buf ) )
+  os.replace( path + '.tmp', path )
+
+#
+# Function LoadSnapshot restores the statistics, the air plane list and the
+# distance rollups from file path, written by SaveSnapshot, and returns the
+# start time of the statistics. All air planes are restored, and those which
+# have expired while this script was not running are handled by the first
+# expiry pass. The distances to the points in RefPnts are only restored if the
+# number of points is unchanged. The distance to RefPnt, the passed flag and the
+# locations, from which the distance is continued, are only restored if RefPnt
+# is unchanged. The rollups are only restored if their layout is unchanged. If
+# there is no valid snapshot, None is returned.
+#
+def LoadSnapshot( path ):
+  try:
+    with open( path, 'rb' ) as f:
+      data= f.read()
+    magic,vers,start,lat,lon,ncnt,npln,npnt= SnapHeader.unpack_from( data, 0 )
+  except (OSError,struct.error):
+    return None
+  if magic != b'APDS'  or  vers != SnapVersion:  return None
+  moved= ( lat, lon ) != ( RefPnt['Latitude'], RefPnt['Longitude'] )
+  def loc( v ):  return None if moved  or  math.isnan( v[0] ) else tuple( v )
+  ext= struct.Struct( '<{}d'.format(npnt) )
+  cnts= [] ;  planes= []
+  try:
+    pos= SnapHeader.size
+    for i in range(ncnt):
+      n= data[pos] ;  key= data[pos+1:pos+1+n].decode()
+      cnts.append( (key,struct.unpack_from( '<q', data, pos+1+n )[0]) )
+      pos+= 9 + n
+    for i in range(npln):
+      r = SnapPlane.unpack_from( data, pos ) ;  pos+= SnapPlane.size
+      ap= Airplane( r[0].rstrip( b'\0' ).decode( 'ascii', 'replace' ) )
+      ap.CallSign= r[1].rstrip( b'\0' ).decode( 'ascii', 'replace' ) or None
+      ap.FrstSeen,ap.LastSeen,ap.LocatMsg,ap.TotalMsg= r[2:6]
+      ap.CurLoc  = loc( r[6:9]  )
+      ap.PrevLoc = loc( r[9:12] )
+      ap.Distance= None if moved  or  math.isnan( r[12] ) else r[12]
+      ap.Passed  = r[13]  and  not moved
+      if ap.Passed:			# Event published before the restart
+        ap.Notified= ap.Distance
+      if npnt > 0:
+        ds= ext.unpack_from( data, pos ) ;  pos+= ext.size
+        if npnt == len(RefPnts)  and  not math.isnan( ds[0] ):
+          ap.Dists= numpy.array( ds ) if RefVect else list( ds )
+      planes.append( ap )
+    rows,pos= adr.Unpack( data, pos )
+  except (IndexError,struct.error,UnicodeDecodeError,zlib.error):
+    return None
+ #
+ # The snapshot is valid, thus restore it. Counters which no longer exist are
+ # skipped.
+ #
+  for (key,val) in cnts:
+    grp,_,key= key.partition( '.' )
+    if grp == 'app':
+      name,_,key= key.rpartition( '.' )
+      st= app.get( name, {} )
+    else:
+      st= ams if grp == 'ams' else aps if grp == 'aps' else {}
+    if key in st:  st[key]= val
+  for ap in planes:
+    apl[ap.IcaoAddr]= ap
+    apx.Add( ap.IcaoAddr, ap.LastSeen )
+  if rows is not None:
+    adr.Restore( rows )
+  return start if start > 0 else None
+
+#
+# Function OpenRecording opens a recorded BaseStation message stream for
+# reading. A gzip compressed file is recognised by its magic number.
+#
+def OpenRecording( path ):
+  with open( path, 'rb' ) as f:
+    magic= f.read( 2 )
+  if magic == b'\x1f\x8b':
+    return gzip.open( path, 'rt', errors='replace' )
+  return open( path, 'r', errors='replace' )
+
+#
+# Function FirstDateTime returns the time stamp of the first message in a list
+# of BaseStation messages which contains a valid time stamp, or None if there
+# is no such message.
+#
+def FirstDateTime( lines ):
+  for line in lines:
+    flds= line.split( ',' )
+    if len(flds) != 22:  continue
+    try:
+      return DecodeDateTime( flds[6], flds[7] )
+    except ValueError:
+      continue
+  return None
+
+#
+# Class ReplayCleaner is the CleanAirplaneList of a replay. The passed air
+# planes are held in a heap, ordered by function PassedOrder, rather than being
+# written. After an expiry pass at time now, each air plane which passes later
+# on is seen after now - PlaneTimeout - 1, as it would have expired otherwise.
+# Method Release returns the held air planes seen up to that moment, the
+# watermark, in order. Thus the order of the log does not depend on the times
+# of the expiry passes.
+#
+class ReplayCleaner( CleanAirplaneList ):
+  def __init__( self ):
+    super().__init__()			# Parent initialisation
+    self.passed= []			# Heap of passed air planes
+    self.count = 0			# Number of passed air planes
+    self.mark  = -math.inf		# Watermark
+
+  def Passed( self, ap ):
+    heapq.heappush( self.passed, (PassedOrder(ap),self.count,ap) )
+    self.count+= 1
+
+  def ExpirePlanes( self, now ):
+    due= super().ExpirePlanes( now )
+    self.mark= now - PlaneTimeout - 1
+    return due
+
+  def Release( self ):
+    planes= []
+    while self.passed  and  self.passed[0][0][0] <= self.mark:
+      planes.append( heapq.heappop( self.passed )[2] )
+    return planes
+
+ #
+ # Method Record writes air plane ap, as returned by Release, to the log file
+ # and the archive.
+ #
+  def Record( self, ap ):
+    CleanAirplaneList.Passed( self, ap )
+
+#
+# Class ShardPool distributes recorded BaseStation messages over jobs worker
+# processes, sharded by ICAO address, such that all messages of one air plane
+# are handled by the same worker. As the expiry and the admission of an air
+# plane only depend on its own messages, each worker finds the same passed air
+# planes as a single process would. The workers are forked, thus they inherit
+# the configuration. Messages are sent to a worker in chunks of ChunkSize
+# messages via a bounded queue. After each chunk, a worker returns the air
+# planes released by its ReplayCleaner together with its watermark. The air
+# planes seen up to the lowest watermark of all workers are merged in the order
+# defined by function PassedOrder, thus only the air planes between the
+# watermarks are held.
+#
+class ShardPool():
+  ChunkSize= 4096			# Messages per chunk
+
+  def __init__( self, jobs ):
+    ctx= multiprocessing.get_context( 'fork' )
+    self.jobs = jobs			# Number of workers
+    self.shard= {}			# Per ICAO address its worker
+    self.bufs = [ [] for i in range(jobs) ]	# Pending messages per worker
+    self.inqs = [ ctx.Queue( 4 ) for i in range(jobs) ]
+    self.outq = ctx.Queue()		# Results of the workers
+    self.marks= [ -math.inf ]*jobs	# Watermark per worker
+    self.stats= [ None ]*jobs		# Final statistics per worker
+    self.held = []			# Heap of passed air planes
+    self.count= 0			# Number of received air planes
+    self.procs= [ ctx.Process( target=ReplayShard, args=(i,self.inqs[i],self.outq) )
+                  for i in range(jobs) ]
+    for proc in self.procs:
+      proc.start()
+
+ #
+ # Private method _put sends item to worker i. If the worker has died, exception
+ # RuntimeError is raised rather than waiting forever.
+ #
+  def _put( self, i, item ):
+    while True:
+      try:
+        return self.inqs[i].put( item, timeout=1 )
+      except queue.Full:
+        if not self.procs[i].is_alive():
+          raise RuntimeError( 'Replay worker {} has died'.format(i) ) from None
+
+ #
+ # Private method _collect receives the results of the workers. If block is
+ # True, it waits for at least one result. It returns the air planes seen up to
+ # the lowest watermark, in order.
+ #
+  def _collect( self, block ):
+    while True:
+      try:
+        i,mark,planes,stats= self.outq.get( block, 1 )
+      except queue.Empty:
+        if not block:  break
+        if any( p.exitcode not in (None,0) for p in self.procs ):
+          raise RuntimeError( 'Replay worker has died' ) from None
+        continue
+      for ap in planes:
+        heapq.heappush( self.held, (PassedOrder(ap),self.count,ap) )
+        self.count+= 1
+      self.marks[i]= mark
+      if stats is not None:  self.stats[i]= stats
+      block= False
+    mark= min( self.marks ) ;  planes= []
+    while self.held  and  self.held[0][0][0] <= mark:
+      planes.append( heapq.heappop( self.held )[2] )
+    return planes
+
+ #
+ # Method Distribute assigns each message in list lines to the worker of its
+ # ICAO address. A malformed message is assigned to the first worker, which
+ # counts it as erred. It returns the passed air planes which can be recorded.
+ #
+  def Distribute( self, lines ):
+    bufs= self.bufs ;  shard= self.shard
+    for line in lines:
+      flds= line.split( ',', 5 )
+      id= flds[4] if len(flds) > 5 else ''
+      i= shard.get( id )
+      if i is None:
+        i= shard[id]= zlib.crc32( id.encode() ) % self.jobs
+      bufs[i].append( line )
+    for i in range(self.jobs):
+      if len(bufs[i]) >= self.ChunkSize:
+        self._put( i, bufs[i] )
+        bufs[i]= []
+    return self._collect( False )
+
+ #
+ # Method Finish sends the remaining messages, waits for the results of the
+ # workers and merges their statistics into the global statistics. It returns
+ # the remaining passed air planes of all workers, in the order defined by
+ # function PassedOrder.
+ #
+  def Finish( self ):
+    for i in range(self.jobs):
+      if self.bufs[i]:
+        self._put( i, self.bufs[i] )
+      self._put( i, None )
+    planes= []
+    while None in self.stats:
+      planes+= self._collect( True )
+    for proc in self.procs:
+      proc.join()
+
+    cms= ams.Local() ;  cps= aps.Local()
+    for (wms,wps,wpp) in self.stats:
+      for key,val in wms.items():  cms[key]+= val
+      for key,val in wps.items():  cps[key]+= val
+      for name in wpp:
+        for key,val in wpp[name].items():  app[name][key]+= val
+    return planes
+
+#
+# Function ReplayShard is the body of replay worker shard. It handles the
+# chunks of messages received via queue inq in the same way as function Replay,
+# until it receives None. After each chunk, its watermark and the air planes
+# released are sent via queue outq, and at the end its statistics as well.
+#
+def ReplayShard( shard, inq, outq ):
+  StoppableThread.SysLog= False		# Report errors on stderr
+  th0= HandleMessages()
+  th1= ReplayCleaner()
+  th0.cleaner= th1
+  while True:
+    lines= inq.get()
+    if lines is None:  break
+    th0.ProcessLines( lines )
+    outq.put( (shard,th1.mark,th1.Release(),None) )
+  apa.Purge( math.inf )			# Reject all addresses on probation
+  th1.ExpirePlanes( math.inf )		# Expire all remaining air planes
+  outq.put( (shard,th1.mark,th1.Release(),(ams.Copy(),aps.Copy(),app)) )
+
+#
+# Function Replay feeds recorded BaseStation messages through the same
+# processing as the live messages, as fast as possible. The time is taken from
+# the messages. At the end of the recording(s), all remaining air planes are
+# expired. The log lines are written to file output, the totals of the
+# statistics to stdout. If archive is not None, the passed air planes are also
+# added to the archive in that directory. If jobs is larger than 1, the messages
+# are handled by that number of worker processes, sharded by ICAO address.
+#
+def Replay( paths, output, archive=None, jobs=1 ):
+  global sosts
+  StoppableThread.SysLog= False		# Report errors on stderr
+  th0= HandleMessages()
+  th1= ReplayCleaner()
+  th0.cleaner= th1
+  th1.outfil= sys.stdout if output == '-' else open( output, 'a' )
+  if archive is not None:
+    th1.archive= PlaneArchive( archive )
+  pool= ShardPool( jobs ) if jobs > 1 else None
+
+  for path in paths:
+    with OpenRecording( path ) as f:
+      while True:
+        chunk= f.readlines( 1 << 16 )
+        if not chunk:  break
+        lines= ''.join( chunk ).splitlines()
+        if sosts is None:		# Start of data acquisition
+          sosts= FirstDateTime( lines )
+          if sosts is not None:
+            tf= EncodeDateTime( sosts )
+            th1.outfil.write( '{} Start data acquisition\n'.format(tf) )
+        if pool is None:
+          th0.ProcessLines( lines )
+          planes= th1.Release()
+        else:
+          planes= pool.Distribute( lines )
+        for ap in planes:
+          th1.Record( ap )
+
+  if pool is None:
+    apa.Purge( math.inf )		# Reject all addresses on probation
+    th1.ExpirePlanes( math.inf )	# Expire all remaining air planes
+    planes= th1.Release()
+  else:
+    planes= pool.Finish()
+  for ap in planes:
+    th1.Record( ap )
+  if th1.outfil is not sys.stdout:
+    th1.outfil.close()
+  if th1.archive is not None:
+    th1.archive.Close()
+
+  for stats in (ams,aps):
+    for key in stats:
+      print( '{:16} {:10d}'.format(key,stats[key]) )
+  for name in app:
+    for key in app[name]:
+      print( '{:16} {:10d}'.format(name + ':' + key,app[name][key]) )
+
+#
+# Asyncio runtime.
+# ================
 #
-signal.signal( signal.SIGINT , HandleSignal )
-signal.signal( signal.SIGTERM, HandleSignal )
+# As an alternative to the threads, the same objects can be driven by a single
+# asyncio event loop. The message stream is read using a stream reader, the
+# expiry of air planes is scheduled using timers of the event loop and the
+# reports are sent by a coroutine. As everything runs in one thread, there are
+# no data races on the global storage.
 #
-# Save time stamp at start of this script. It is used to show the length of the
-# period in which the statistics shown in tables are collected.
+
+#
+# Coroutine AsyncCollector connects to one feed of the data collector and
+# handles the messages received, until the coroutine is cancelled. The
+# connection is supervised in the same way as by thread HandleMessages: it is
+# rebuilt if it is closed or stalls, and if collect is True the data collector
+# is (re)started if needed. Event ready is set once connected.
+#
+async def AsyncCollector( hm, host, port, collect, ready ):
+  feed= FeedSupervisor( host, port, collect )
+  hm.LogMessage( 'Starting task for {}'.format(feed.name) )
+  try:
+    while True:
+      now= time.time()
+      if now < feed.retry:
+        await asyncio.sleep( feed.retry - now )
+        now= time.time()
+      try:
+        reader,writer= await asyncio.wait_for(
+                         asyncio.open_connection( host, port ), ConnectTimeout )
+      except (OSError,asyncio.TimeoutError) as e:
+        if collect  and  isinstance( e, ConnectionRefusedError ):
+          if now >= feed.probe  and  not hm._collector_running():
+            hm._start_collector()
+            feed.probe= now + ReadyTimeout
+        feed.Failed( now )
+        hm.LogError( 'connect', 'Error: connect to {} failed: {}'.format(feed.name,e) )
+        continue
+
+      feed.Up( now )
+      hm.LogMessage( 'Connected to {}'.format(feed.name) )
+      ready.set()
+      if Input == 'beast':
+        framer= BeastReader( None ) ;  process= hm.ProcessFrames
+      else:
+        framer= LineReader( None )  ;  process= hm.ProcessLines
+      try:
+        while True:
+          try:
+            data= await asyncio.wait_for( reader.read( ReadSize ), StallTime )
+          except asyncio.TimeoutError:
+            hm.LogMessage( 'Error: no data received from {}'.format(feed.name) )
+            break
+          except OSError as e:
+            hm.LogMessage( 'Error: {}, feed {}'.format(e,feed.name) )
+            break
+          if not data:
+            hm.LogMessage( 'Error: connection closed by {}'.format(feed.name) )
+            break
+          amx['read_size'].Observe( len(data) )
+          now= time.time()
+          process( framer.Feed(data), now, feed.name )
+          hm.Sample( now )
+          hm.FlushErrors()
+      finally:
+        writer.close()
+      feed.Down( time.time() )
+  finally:
+    hm.LogMessage( 'Stopping task for {}'.format(feed.name) )
+
+#
+# Function AsyncExpire removes the expired air planes, saves a snapshot if one
+# is due and schedules its next invocation at the time the next air plane may
+# expire or the next snapshot is due.
 #
-sosts= time.time()			# Start-of-script time stamp
-sosrf= EncodeDateTime( sosts, ' ' )	#  in human readable form
+def AsyncExpire( loop, cl ):
+  now= time.time()
+  due= min( cl.ExpirePlanes( now ), cl.Checkpoint( now ) )
+  delay= min( max(due-time.time(),0), PlaneTimeout )
+  cl.timer= loop.call_at( loop.time()+delay, AsyncExpire, loop, cl )
+
 #
-# Calculate and save the cartesian coordinates of the reference point.
+# Coroutine AsyncMonitor sends the statistics to the Xymon server and the other
+# sinks once every five minutes. The combo message is delivered by XymonSender
+# object xs in a worker thread of the event loop, thus the loop is not blocked.
+# If the delivery fails, it is retried before the next report is due, with an
+# exponentially increasing interval as done by thread XymonSender.
 #
-RefPnt['Cartesian']= Cartesian( RefPnt['Latitude'], RefPnt['Longitude'], 0 )
+async def AsyncMonitor( ma, xs ):
+  ma.LogMessage( 'Starting task' )
+  loop= asyncio.get_running_loop()
+  delay= XyBackoffMin			# Retry interval
+  try:
+    while True:
+      snap = MetricsSnapshot()
+      combo= xs.Combine( ma.BuildReports(snap) )
+      done = await loop.run_in_executor( None, xs.Deliver, combo )
+      ma.Export( snap )
+      due  = time.time() + ma.WaitTime( 300, 2 )	# Run once every five minutes
+      while not done  and  time.time() + delay < due:
+        await asyncio.sleep( delay )
+        delay= min( 2*delay, XyBackoffMax )
+        done = await loop.run_in_executor( None, xs.Deliver, None )
+      if done:  delay= XyBackoffMin
+      await asyncio.sleep( max( due - time.time(), 0 ) )
+  finally:
+    ma.LogMessage( 'Stopping task' )
+
 #
-# Start the threads making up this program.
+# Coroutine AsyncQuery answers one local query, using the QueryServer object
+# qs.
 #
-threads= []
-th0= HandleMessages()    ;  threads.append(th0) ;  th0.start()
-th1= CleanAirplaneList() ;  threads.append(th1) ;  th1.start()
-time.sleep( 10 )			# Wait for some data to arrive
-th2= MonitorAirspace()   ;  threads.append(th2) ;  th2.start()
+async def AsyncQuery( qs, reader, writer ):
+  try:
+    query= await reader.readline()
+    writer.write( qs.Answer( query.decode(errors='replace') ).encode() )
+    await writer.drain()
+  finally:
+    writer.close()
+
 #
-# Monitor the state of the threads of this script. If one thread dies or if an
-# external signal is received, all (other) threads, including this main thread,
-# should stop (too) in a graceful way.
+# Coroutine AsyncSubscriber sends the events to one subscriber, in the same way
+# as thread EventStream does. The events are queued in a bounded asyncio.Queue.
 #
-while len(threads) > 0:
+async def AsyncSubscriber( reader, writer ):
+  q= asyncio.Queue( EventQueue )	# Events to send
+  if not aev.Subscribe( q ):
+    writer.close()
+    return
   try:
-    all_alive= True			# See if all threads are currently alive
-    for t in threads:
-      all_alive= all_alive and t.is_alive()
-    if all_alive:
-      MainThread.wait( 10 )		# If so, wait some time
-
-    if not all_alive  or  MainThread.is_set():
-      for t in reversed( threads ):	# Note the order of this loop
-        if t.is_alive():
-          t.stop()
-        t.join()
-        threads.remove( t )		# Thread has stopped
-
-  except KeyboardInterrupt:
-    MainThread.set()			# Set flag to stop this script
+    while True:
+      writer.write( await q.get() )
+      await asyncio.wait_for( writer.drain(), EventTimeout )
+  except (OSError,asyncio.TimeoutError):
+    pass				# Subscriber is gone or stuck
+  finally:
+    aev.Unsubscribe( q )
+    writer.close()
+
+#
+# Coroutine AsyncDaemon is the asyncio version of function Daemon. It stops if
+# a termination signal is received or if one of its tasks ends, which only
+# happens due to an unexpected exception. A lost connection to a feed is rebuilt
+# by its collector task, thus it does not stop this coroutine.
+#
+async def AsyncDaemon():
+  global sosts, sosrf, aev
+  loop= asyncio.get_running_loop()
+  stop= asyncio.Event()			# Set to stop this script
+  def terminate( signum ):
+    HandleSignal( signum, None )
+    stop.set()
+  for signum in (signal.SIGINT,signal.SIGTERM):
+    loop.add_signal_handler( signum, terminate, signum )
+
+  sosts= time.time()			# Start-of-script time stamp
+  if Snapshot is not None:		# Restore state of previous run
+    sosts= LoadSnapshot( Snapshot ) or sosts
+  sosrf= EncodeDateTime( sosts, ' ' )	#  in human readable form
+  if EventSocket is not None:		# Publish pass events
+    aev= EventHub()
+    evs= await asyncio.start_server( AsyncSubscriber, sock=EventListener() )
+
+  hm= HandleMessages()
+  cl= CleanAirplaneList()
+  xs= XymonSender()
+  ma= MonitorAirspace( xs )
+  cl.Open( sosts )
+  cl.timer = loop.call_soon( AsyncExpire, loop, cl )
+
+  feeds= Feeds or [ (ServerHost,BeastPort if Input == 'beast' else ServerPort) ]
+  if len(feeds) > 1:
+    hm.dedup= Deduplicator( DedupWindow )
+  ready= asyncio.Event()		# Set once a feed is connected
+  colls= [ AsyncCollector( hm, host, port, i == 0, ready )
+           for i,(host,port) in enumerate(feeds) ]
+  tasks= [ asyncio.create_task( stop.wait() ),
+           asyncio.gather( *colls ) ]
+  waiter= asyncio.create_task( ready.wait() )
+  done,pend= await asyncio.wait( tasks + [waiter], timeout=ReadyTimeout,
+                                 return_when=asyncio.FIRST_COMPLETED )
+  waiter.cancel()
+  if not any( t in done for t in tasks ):
+    tasks.append( asyncio.create_task( AsyncMonitor(ma,xs) ) )
+    if QuerySocket is not None:
+      qs= QueryServer()
+      if os.path.exists( QuerySocket ):  os.remove( QuerySocket )
+      srv= await asyncio.start_unix_server(
+             lambda r,w: AsyncQuery(qs,r,w), path=QuerySocket )
+    await asyncio.wait( tasks, return_when=asyncio.FIRST_COMPLETED )
+    if QuerySocket is not None:
+      srv.close()
+      os.remove( QuerySocket )
+  for t in reversed( tasks ):		# Note the order of this loop
+    t.cancel()
+  await asyncio.gather( *tasks, return_exceptions=True )
+  cl.timer.cancel()
+  cl.Close()
+  if EventSocket is not None:
+    evs.close()
+    if isinstance( EventSocket, str ):  os.remove( EventSocket )
+  cl.SaveState()			# Final snapshot
+
+#
+# Function Daemon runs the threads making up this program, until a termination
+# signal is received or until one of the threads dies.
+#
+def Daemon():
+  global sosts, sosrf, aev
+ #
+ # Set up handling of termination signals. They are converted into an exception.
+ #
+  signal.signal( signal.SIGINT , HandleSignal )
+  signal.signal( signal.SIGTERM, HandleSignal )
+ #
+ # Save time stamp at start of this script. It is used to show the length of the
+ # period in which the statistics shown in tables are collected. If the state of
+ # a previous run is restored, that period started at the start of that run.
+ #
+  sosts= time.time()			# Start-of-script time stamp
+  if Snapshot is not None:		# Restore state of previous run
+    sosts= LoadSnapshot( Snapshot ) or sosts
+  sosrf= EncodeDateTime( sosts, ' ' )	#  in human readable form
+ #
+ # Start the threads making up this program. The subscribers to the events are
+ # accepted before the messages are handled.
+ #
+  threads= []
+  if EventSocket is not None:
+    aev= EventHub()
+    th5= EventServer()     ;  threads.append(th5) ;  th5.start()
+  th0= HandleMessages()    ;  threads.append(th0) ;  th0.start()
+  th1= CleanAirplaneList() ;  threads.append(th1) ;  th1.start()
+  th2= XymonSender()       ;  threads.append(th2) ;  th2.start()
+  th0.ready.wait( ReadyTimeout )	# Wait for a feed to be connected
+  th3= MonitorAirspace(th2);  threads.append(th3) ;  th3.start()
+  if QuerySocket is not None:
+    th4= QueryServer(th0.ring) ;  threads.append(th4) ;  th4.start()
+ #
+ # Monitor the state of the threads of this script. If one thread dies or if an
+ # external signal is received, all (other) threads, including this main thread,
+ # should stop (too) in a graceful way.
+ #
+  while len(threads) > 0:
+    try:
+      all_alive= True			# See if all threads are currently alive
+      for t in threads:
+        all_alive= all_alive and t.is_alive()
+      if all_alive:
+        MainThread.wait( 10 )		# If so, wait some time
+
+      if not all_alive  or  MainThread.is_set():
+        for t in reversed( threads ):	# Note the order of this loop
+          if t.is_alive():
+            t.stop()
+          t.join()
+          threads.remove( t )		# Thread has stopped
+
+    except KeyboardInterrupt:
+      MainThread.set()			# Set flag to stop this script
+ #
+ # All threads have stopped, thus the state of this script is consistent. Save it
+ # for the next run.
+ #
+  th1.SaveState()
+
+
+if __name__ == '__main__':
+  parser= argparse.ArgumentParser( description='Determine the distribution of '
+            'the closest distance of passing air planes to a reference point.' )
+  parser.add_argument( '--replay', nargs='+', metavar='FILE',
+            help='process recorded BaseStation messages (plain or gzip) '
+                 'as fast as possible, rather than the live message stream' )
+  parser.add_argument( '--asyncio', action='store_true',
+            help='run on a single asyncio event loop rather than in threads' )
+  parser.add_argument( '--output', default='-', metavar='FILE',
+            help='file to append the passed air planes to in replay mode, '
+                 'default stdout' )
+  parser.add_argument( '--archive', metavar='DIR',
+            help='archive directory to add the passed air planes to in '
+                 'replay mode' )
+  parser.add_argument( '--jobs', type=int, default=1, metavar='N',
+            help='number of worker processes in replay mode, default 1' )
+  args= parser.parse_args()
+
+  Initialise()
+  if args.replay:
+    Replay( args.replay, args.output, args.archive, args.jobs )
+  elif args.asyncio:
+    asyncio.run( AsyncDaemon() )
+  else:
+    Daemon()
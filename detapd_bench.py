@@ -0,0 +1,475 @@
+#!/usr/bin/python3
+#
+# detapd_bench, benchmark of detapd:
+#
+# Generate a synthetic, reproducible stream of BaseStation messages and measure
+# the time needed by the various stages of detapd to handle it. The results are
+# written in JSON format, such that the results of different runs can be
+# compared.
+#
+import argparse				# Command line parsing
+import datetime
+import json
+import math
+import platform
+import random
+import socket
+import sys
+import threading
+import time
+
+import detapd
+
+#
+# Configuration parameters.
+# =========================
+#
+
+#
+# Define the default mix of transmission types 1 up to 8, expressed as relative
+# weights. It resembles the mix produced by dump1090 for ADS-B equipped air
+# planes.
+#
+TypeMix= { 1: 2, 2: 0, 3: 30, 4: 30, 5: 15, 6: 2, 7: 15, 8: 6 }
+
+#
+# Utilities.
+# ==========
+#
+
+#
+# Function ParseMix converts a string of the form 'tt:weight,...' into a
+# dictionary of weights per transmission type.
+#
+def ParseMix( arg ):
+  mix= {}
+  for item in arg.split( ',' ):
+    tt,w= item.split( ':' )
+    mix[int(tt)]= float( w )
+  return mix
+
+#
+# Function ResetState clears the global storage of detapd, such that each stage
+# of the benchmark starts with the same state.
+#
+def ResetState():
+  detapd.apl.clear()
+  for stats in [detapd.ams,detapd.aps] + list( detapd.app.values() ):
+    for key in stats:  stats[key]= 0
+  detapd.Initialise()
+
+#
+# Class SbsGenerator generates a stream of BaseStation MSG messages. A fixed
+# number of air planes is present at any time. Each air plane flies along a
+# straight line past the reference point at a random cross-track distance.
+# Once it is too far away, it is replaced by a new air plane. A fraction of the
+# messages is garbage or has a null ICAO address.
+#
+class SbsGenerator():
+  def __init__( self, seed, planes, rate, mix, garbage, zero ):
+    self.rnd    = random.Random( seed )
+    self.count  = planes		# Number of concurrent air planes
+    self.rate   = rate			# Messages per second
+    self.types  = list( mix )		# Transmission types
+    self.weights= [ mix[tt] for tt in self.types ]
+    self.garbage= garbage		# Fraction garbage messages
+    self.zero   = zero			# Fraction null addresses
+    self.lat0   = float( detapd.RefPnt['Latitude'] )
+    self.lon0   = float( detapd.RefPnt['Longitude'] )
+    self.mpdlat = 111195.0		# Metres per degree latitude
+    self.mpdlon = self.mpdlat*math.cos( math.radians(self.lat0) )
+    self.planes = None			# Created at first message
+
+ #
+ # Private method _new_plane creates a new air plane at time now at 60 [km]
+ # from the reference point, flying towards it with some cross-track offset.
+ # The start point lies within the radius of 61 [km] beyond which an air plane
+ # is replaced, thus it is replaced only after it has passed by.
+ #
+  def _new_plane( self, now ):
+    r= self.rnd
+    brg= r.uniform( 0, 2*math.pi )	# Direction of start point
+    off= r.uniform( -20000, 20000 )	# Cross-track distance, [m]
+    rng= math.sqrt( 60000**2 - off**2 )	# Along-track distance, [m]
+    x= rng*math.sin(brg) + off*math.cos(brg)	# Start point, [m]
+    y= rng*math.cos(brg) - off*math.sin(brg)
+    spd= r.uniform( 120, 250 )		# Ground speed, [m/s]
+    return dict( icao= '{:06X}'.format(r.randrange(1,1<<24)),
+                 call= 'TST{:04d}'.format(r.randrange(10000)),
+                 x= x, y= y, vx= -spd*math.sin(brg), vy= -spd*math.cos(brg),
+                 alt= r.randrange(1000,40000,25), t= now )
+
+ #
+ # Method Lines returns a list of count messages, starting at Unix time start,
+ # together with the time stamp of each message.
+ #
+  def Lines( self, count, start ):
+    r= self.rnd
+    lines= [] ;  stamps= []
+    dt= 1.0 / self.rate
+    if self.planes is None:
+      self.planes= [ self._new_plane( start ) for i in range(self.count) ]
+    for k in range(count):
+      now= start + k*dt
+      stamps.append( now )
+      if r.random() < self.garbage:
+        lines.append( 'MSG,3,1,1,{:06X},1,garbage'.format(r.randrange(1<<24)) )
+        continue
+      i = r.randrange( len(self.planes) )
+      ap= self.planes[i]
+      ap['x']+= ap['vx']*(now - ap['t']) ;  ap['y']+= ap['vy']*(now - ap['t'])
+      ap['t']= now
+      if ap['x']**2 + ap['y']**2 > 61000**2:
+        ap= self.planes[i]= self._new_plane( now )
+      tt= r.choices( self.types, self.weights )[0]
+      id= '000000' if r.random() < self.zero else ap['icao']
+      ts= datetime.datetime.fromtimestamp( now )
+      d = ts.strftime( '%Y/%m/%d' )
+      t = ts.strftime( '%H:%M:%S.%f' )[:-3]
+      f = [ 'MSG', str(tt), '1', '1', id, '1', d, t, d, t ] + ['']*11 + ['0']
+      if tt == 1:
+        f[10]= ap['call']
+      elif tt == 3:
+        f[11]= str( ap['alt'] )
+        f[14]= '{:.5f}'.format( self.lat0 + ap['y']/self.mpdlat )
+        f[15]= '{:.5f}'.format( self.lon0 + ap['x']/self.mpdlon )
+      lines.append( ','.join(f) )
+    return (lines,stamps)
+
+
+#
+# Benchmark stages.
+# =================
+#
+
+#
+# Function Result builds the result record of one stage.
+#
+def Result( seconds, count ):
+  return dict( seconds= seconds, count= count,
+               rate= count/seconds if seconds > 0 else None )
+
+#
+# Function ReferenceLines handles list lines of BaseStation messages in the way
+# HandleMessages did before function ParseSbs was introduced: each line is split
+# into all of its fields, the number of fields and the message type are checked,
+# the time stamp is decoded in replay mode, that is if now is None, and the
+# fields are converted per transmission type. Each address is entered
+# immediately. It is the reference of the stages 'parse' and 'replay'.
+#
+def ReferenceLines( hm, lines, now ):
+  cnt= detapd.ams.Local()
+  apl= detapd.apl
+  bpl= [] ;  blat= [] ;  blon= [] ;  balt= []	# Position reports
+  for line in lines:
+    if line == '':  continue
+
+    cnt['total_messages']+= 1
+    flds= line.split( ',' )
+    if len(flds) != 22:
+      hm.LogError( 'format', 'Unexpected number of fields in "{}"'.format(line) )
+      cnt['erred_messages']+= 1
+      continue
+    if flds[0] != 'MSG':
+      hm.LogError( 'format', 'Unexpected message type received: "{}"'.format(flds[0]) )
+      cnt['erred_messages']+= 1
+      continue
+    id= flds[4]				# ICAO airplane address
+    if id == '000000':
+      cnt['zero_id_messages']+= 1
+      continue
+
+    if now is None:
+      try:
+        uts= detapd.DecodeDateTime( flds[6], flds[7] )
+      except ValueError:
+        hm.LogError( 'time', 'Unexpected time stamp in "{}"'.format(line) )
+        cnt['erred_messages']+= 1
+        continue
+      if uts >= hm.due:
+        if bpl:
+          detapd.ExtractDistances( bpl, blat, blon, balt )
+          bpl= [] ;  blat= [] ;  blon= [] ;  balt= []
+        hm.due= min( hm.cleaner.ExpirePlanes( uts ), uts + detapd.PlaneTimeout )
+    else:
+      uts= now
+
+    if id not in apl:
+      apl[id]= detapd.Airplane( id )
+    apl[id].SetLastSeen( uts )
+    apl[id].TotalMsg+= 1
+    tt= int(flds[1])			# Transmission type
+    if   tt == 1:
+      apl[id].SetCallSign( flds[10] )
+      cnt['procd_messages']+= 1
+    elif tt == 3:
+      bpl.append( apl[id] )
+      blat.append( float(flds[14]) )
+      blon.append( float(flds[15]) )
+      balt.append( int(flds[11]) )
+      apl[id].LocatMsg+= 1
+      cnt['procd_messages']+= 1
+    elif tt in [2,4,5,6,7,8]:
+      pass
+    else:
+      hm.LogError( 'format', 'Unexpected MSG transmission type received: {}'.format(tt) )
+      cnt['erred_messages']+= 1
+
+  if bpl:
+    detapd.ExtractDistances( bpl, blat, blon, balt )
+
+#
+# Function BenchParse measures the time needed to parse and dispatch the
+# messages, excluding the computation of the distances. If replay is False, the
+# messages are handled in batches as received from a socket at the times in
+# stamps, otherwise the time is taken from each message and the air planes are
+# expired in between, with the passed ones written to file outfil. The same is
+# measured for function ReferenceLines, included as the reference.
+#
+def BenchParse( lines, stamps, batch, outfil, replay=False ):
+  def run( process ):
+    ResetState()
+    hm= detapd.HandleMessages()
+    hm.cleaner= detapd.CleanAirplaneList()
+    hm.cleaner.outfil= outfil
+    t0= time.perf_counter()
+    for i in range( 0, len(lines), batch ):
+      process( hm, lines[i:i+batch], None if replay else stamps[i] )
+    return Result( time.perf_counter() - t0, len(lines) )
+
+  save= detapd.ExtractDistances
+  detapd.ExtractDistances= lambda *args: None
+  try:
+    result= run( lambda hm,lines,now: hm.ProcessLines( lines, now ) )
+    result['reference']= run( ReferenceLines )
+  finally:
+    detapd.ExtractDistances= save
+  return result
+
+#
+# Function BenchFields measures the rate of function ParseSbs on its own.
+#
+def BenchFields( lines ):
+  t0= time.perf_counter()
+  for line in lines:
+    try:
+      detapd.ParseSbs( line )
+    except ValueError:
+      pass
+  t1= time.perf_counter()
+  return Result( t1-t0, len(lines) )
+
+#
+# Function BenchExtract measures the time needed to compute the closest
+# distance, using the position reports of the messages in batches.
+#
+def BenchExtract( lines, batch ):
+  ResetState()
+  planes= {} ;  batches= [] ;  n= 0
+  for i in range( 0, len(lines), batch ):
+    bpl= [] ;  blat= [] ;  blon= [] ;  balt= []
+    for line in lines[i:i+batch]:
+      f= line.split( ',' )
+      if len(f) != 22  or  f[1] != '3'  or  f[4] == '000000':  continue
+      if f[4] not in planes:  planes[f[4]]= detapd.Airplane( f[4] )
+      bpl.append( planes[f[4]] )
+      blat.append( float(f[14]) ) ;  blon.append( float(f[15]) )
+      balt.append( int(f[11]) )
+    if bpl:
+      batches.append( (bpl,blat,blon,balt) )
+      n+= len( bpl )
+  t0= time.perf_counter()
+  for b in batches:
+    detapd.ExtractDistances( *b )
+  t1= time.perf_counter()
+  return Result( t1-t0, n )
+
+#
+# Function BenchGeometry measures the conversion to cartesian coordinates,
+# function Cartesian, and the lower bound of the distance of a flight segment,
+# function SegmentBound, for count random positions within 300 [km] of the
+# reference point. Each position is paired with a previous position at most 30
+# [km] away, the distance flown in PlaneTimeout seconds. Per pair the bound is
+# compared with the closest distance of the segment to the reference point. The
+# rates of both functions and the largest excess of the bound are returned.
+#
+def BenchGeometry( count ):
+  ResetState()
+  rnd= random.Random( 1 )
+  lat0= detapd.RefPnt['Latitude'] ;  lon0= detapd.RefPnt['Longitude']
+  mpdlon= 111195.0*math.cos( math.radians(lat0) )
+  def position( x, y ):
+    return ( lat0 + y/111195.0, lon0 + x/mpdlon, rnd.randrange(0,40000,25) )
+  pos= [] ;  prv= []
+  for i in range(count):
+    rng= 300000*math.sqrt( rnd.random() ) ;  brg= rnd.uniform( 0, 2*math.pi )
+    x= rng*math.sin(brg) ;  y= rng*math.cos(brg)
+    pos.append( position( x, y ) )
+    rng= rnd.uniform( 0, 30000 ) ;  brg= rnd.uniform( 0, 2*math.pi )
+    prv.append( position( x + rng*math.sin(brg), y + rng*math.cos(brg) ) )
+  t0= time.perf_counter()
+  cart= [ detapd.Cartesian( *p ) for p in pos ]
+  t1= time.perf_counter()
+  prev= [ detapd.Cartesian( *p ) for p in prv ]
+  t2= time.perf_counter()
+  bnds= [ detapd.SegmentBound( p, q ) for p,q in zip(prev,cart) ]
+  t3= time.perf_counter()
+
+  def closest( p, q, r ):		# Distance of r to segment p-q
+    d= [ q[i]-p[i] for i in range(3) ]
+    s= sum( d[i]*(r[i]-p[i]) for i in range(3) ) / sum( x*x for x in d )
+    s= min( max(s,0.0), 1.0 )
+    return detapd.Distance( [ p[i] + s*d[i] for i in range(3) ], r )
+  excess= 0.0
+  for i in range(count):
+    d= closest( prev[i], cart[i], detapd.Origin )
+    excess= max( excess, bnds[i] - d )
+  result= Result( t1-t0, count )
+  result['bound']= Result( t3-t2, count )
+  result['max_excess']= excess
+  return result
+
+#
+# Function BenchExpire measures the time needed to expire count air planes,
+# which were last seen spread over one minute.
+#
+def BenchExpire( count, outfil ):
+  ResetState()
+  cl= detapd.CleanAirplaneList()
+  cl.outfil= outfil
+  now= time.time()
+  for i in range(count):
+    id= '{:06X}'.format( i+1 )
+    ap= detapd.apl[id]= detapd.Airplane( id )
+    ap.SetLastSeen( now + 60*i/count )
+    ap.Distance= 1000.0*(i % 40)
+  t0= time.perf_counter()
+  cl.ExpirePlanes( now + 60 + detapd.PlaneTimeout + 1 )
+  t1= time.perf_counter()
+  return Result( t1-t0, count )
+
+#
+# Function BenchReport measures the time needed to build the Xymon reports while
+# count air planes are being tracked.
+#
+def BenchReport( count, repeat ):
+  ResetState()
+  detapd.sosts= time.time()
+  detapd.sosrf= detapd.EncodeDateTime( detapd.sosts, ' ' )
+  for i in range(count):
+    id= '{:06X}'.format( i+1 )
+    ap= detapd.apl[id]= detapd.Airplane( id )
+    ap.Distance= None if i % 7 == 0 else 1000.0*(i % 40)
+  ma= detapd.MonitorAirspace( None )
+  t0= time.perf_counter()
+  for i in range(repeat):
+    ma.BuildReports()
+  t1= time.perf_counter()
+  return Result( t1-t0, repeat )
+
+#
+# Function BenchSocket measures the end-to-end throughput of thread
+# HandleMessages. The messages are served by a local TCP server, as fast as
+# possible, after which the server closes the connection. The ring buffer is
+# made large enough to hold all messages, as the local server is much faster
+# than any receiver. The thread is stopped once all messages are handled.
+#
+def BenchSocket( lines ):
+  ResetState()
+  detapd.RingSize= len( lines )
+  data= ( '\r\n'.join(lines) + '\r\n' ).encode()
+  srv= socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+  srv.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+  srv.bind( ('127.0.0.1',0) )
+  srv.listen( 1 )
+  def serve():
+    conn,addr= srv.accept()
+    conn.sendall( data )
+    conn.close()
+  server= threading.Thread( target=serve )
+  server.start()
+
+  detapd.ServerHost,detapd.ServerPort= srv.getsockname()
+  hm= detapd.HandleMessages()
+  t0= time.perf_counter()
+  hm.start()
+  while detapd.ams['total_messages'] + detapd.ams['drop_messages'] < len(lines):
+    time.sleep( 0.001 )
+  t1= time.perf_counter()
+  hm.stop()
+  hm.join()
+  server.join()
+  srv.close()
+  result= Result( t1-t0, detapd.ams['total_messages'] )
+  result['dropped']= detapd.ams['drop_messages']
+  return result
+
+
+#
+# MAIN PROGRAM.
+# =============
+#
+if __name__ == '__main__':
+  parser= argparse.ArgumentParser( description='Benchmark the stages of detapd '
+            'using a synthetic stream of BaseStation messages.' )
+  parser.add_argument( '--seed'    , type=int  , default=1 )
+  parser.add_argument( '--messages', type=int  , default=100000,
+            help='number of messages to generate' )
+  parser.add_argument( '--planes'  , type=int  , default=100,
+            help='number of concurrent air planes' )
+  parser.add_argument( '--rate'    , type=float, default=50.0,
+            help='simulated message rate [1/s]' )
+  parser.add_argument( '--mix'     , type=ParseMix, default=TypeMix,
+            help='weights of the transmission types, as tt:weight,...' )
+  parser.add_argument( '--garbage' , type=float, default=0.002,
+            help='fraction of garbage messages' )
+  parser.add_argument( '--zero'    , type=float, default=0.002,
+            help='fraction of messages with a null ICAO address' )
+  parser.add_argument( '--batch'   , type=int  , default=32,
+            help='messages per socket read' )
+  parser.add_argument( '--lat'     , type=float, default=52.0,
+            help='latitude of the reference point' )
+  parser.add_argument( '--lon'     , type=float, default=5.0,
+            help='longitude of the reference point' )
+  parser.add_argument( '--points'  , type=int  , default=0,
+            help='number of additional reference points' )
+  parser.add_argument( '--stages'  , default='parse,replay,fields,extract,geometry,expire,report,socket' )
+  parser.add_argument( '--output'  , default='-', metavar='FILE',
+            help='file to write the JSON results to, default stdout' )
+  args= parser.parse_args()
+
+  detapd.RefPnt.update( Latitude=args.lat, Longitude=args.lon )
+  rnd= random.Random( args.seed )
+  detapd.RefPnts= [ dict( Name='point{}'.format(k),
+                          Latitude = args.lat + rnd.uniform(-0.2,0.2),
+                          Longitude= args.lon + rnd.uniform(-0.3,0.3) )
+                    for k in range(args.points) ]
+  detapd.StoppableThread.SysLog= False	# Report errors on stderr
+  gen= SbsGenerator( args.seed, args.planes, args.rate, args.mix,
+                     args.garbage, args.zero )
+  lines,stamps= gen.Lines( args.messages, 1.5e9 )
+
+  results= {}
+  with open( '/dev/null', 'w' ) as devnull:
+    for stage in args.stages.split( ',' ):
+      if   stage == 'parse'  :  results[stage]= BenchParse( lines, stamps, args.batch, devnull )
+      elif stage == 'replay' :  results[stage]= BenchParse( lines, stamps, args.batch, devnull, True )
+      elif stage == 'fields' :  results[stage]= BenchFields( lines )
+      elif stage == 'extract':  results[stage]= BenchExtract( lines, args.batch )
+      elif stage == 'geometry': results[stage]= BenchGeometry( args.messages )
+      elif stage == 'expire' :  results[stage]= BenchExpire( 10*args.planes, devnull )
+      elif stage == 'report' :  results[stage]= BenchReport( args.planes, 100 )
+      elif stage == 'socket' :  results[stage]= BenchSocket( lines )
+      else:
+        parser.error( 'unknown stage {}'.format(stage) )
+
+  report= dict(
+    config = dict( (k,v) for k,v in vars(args).items() if k != 'output' ),
+    system = dict( python= platform.python_version(),
+                   machine= platform.machine(),
+                   numpy= detapd.numpy is not None ),
+    results= results )
+  out= sys.stdout if args.output == '-' else open( args.output, 'w' )
+  json.dump( report, out, indent=2, default=str )
+  out.write( '\n' )
+  if out is not sys.stdout:  out.close()
@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+#
+# detapq, DETermine_Air_Plane_distance Query:
+#
+# Query the binary archive of passed air planes, written by detapd.py, and
+# compute the distribution of the closest distances for a range of time, using
+# any set of distance classes. Only the segments and blocks of the archive which
+# overlap with the requested time range are read. Moreover, an existing text
+# log file of detapd.py can be converted into an archive.
+#
+import argparse				# Command line parsing
+import datetime
+import glob
+import math
+import mmap
+import os
+import re
+import time
+
+import detapd
+
+#
+# Utilities.
+# ==========
+#
+
+#
+# Function ParseTime converts a date, optionally followed by a time of day, in
+# ISO8601 format into a Unix time stamp, using the local time zone.
+#
+def ParseTime( arg ):
+  return datetime.datetime.fromisoformat( arg ).timestamp()
+
+#
+# Function ParseHours converts a time-of-day range 'HH:MM-HH:MM' into a tuple of
+# two offsets in seconds since midnight.
+#
+def ParseHours( arg ):
+  def sod( hm ):
+    h,m= hm.split( ':' )
+    return int(h)*3600 + int(m)*60
+  start,stop= arg.split( '-' )
+  return (sod(start),sod(stop))
+
+#
+# Function ParseBins converts a comma-separated list of increasing class
+# boundaries in [m] into a table of distance classes, in the format of
+# detapd.DistClass.
+#
+def ParseBins( arg ):
+  edges= [ int(e) for e in arg.split( ',' ) ]
+  table= [ ( 'dist_unknown', None, 'dunkn' ) ]
+  lower= 0
+  for e in edges + [math.inf]:
+    name= 'dist_{}_{}_m'.format( lower, 'inf' if e == math.inf else e )
+    table.append( (name, e, name) )
+    lower= e
+  return table
+
+#
+# Function Segments returns the base names of the segments of the archive in
+# directory path which may contain air planes passed in [t0,t1).
+#
+def Segments( path, t0, t1 ):
+  d0= time.strftime( '%Y%m%d', time.localtime(t0) ) if t0 > 0        else ''
+  d1= time.strftime( '%Y%m%d', time.localtime(t1) ) if t1 < math.inf else '99999999'
+  bases= []
+  for fn in sorted( glob.glob( os.path.join(path,'*.apd') ) ):
+    day= os.path.basename( fn )[:-4]
+    if d0 <= day <= d1:
+      bases.append( fn[:-4] )
+  return bases
+
+#
+# Function ReadSegment returns a list of (last seen, distance) tuples of the air
+# planes in segment base which have passed in [t0,t1). The index of the
+# segment is used to skip the blocks outside of the time range. A block without
+# an index entry is always read.
+#
+def ReadSegment( base, t0, t1 ):
+  rsz= detapd.ArchiveRecord.size
+  bsz= detapd.ArchiveBlock
+  idx= []
+  if os.path.exists( base + '.idx' ):
+    with open( base + '.idx', 'rb' ) as f:
+      idx= list( detapd.ArchiveIndex.iter_unpack( f.read() ) )
+
+  result= []
+  with open( base + '.apd', 'rb' ) as f:
+    size= os.fstat( f.fileno() ).st_size // rsz * rsz
+    if size == 0:  return result
+    with mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) as mm:
+      view= memoryview( mm )
+      for blk in range( (size//rsz + bsz - 1) // bsz ):
+        if blk < len(idx):
+          lo,hi= idx[blk]
+          if hi < t0  or  lo >= t1:  continue
+        start= blk*bsz*rsz
+        for r in detapd.ArchiveRecord.iter_unpack( view[start:min(start+bsz*rsz,size)] ):
+          if t0 <= r[1] < t1:
+            result.append( (r[1],r[4]) )
+      view.release()
+  return result
+
+#
+# Function InHours returns True if Unix time uts lies within the time-of-day
+# range hours, which may wrap around midnight.
+#
+def InHours( uts, hours ):
+  lt = time.localtime( uts )
+  sod= lt.tm_hour*3600 + lt.tm_min*60 + lt.tm_sec
+  if hours[0] <= hours[1]:
+    return hours[0] <= sod < hours[1]
+  return sod >= hours[0]  or  sod < hours[1]
+
+#
+# Function Query computes the distance distribution of the air planes in the
+# archive in directory path, passed in [t0,t1) and optionally within a
+# time-of-day range, and prints it.
+#
+def Query( path, t0, t1, hours, table ):
+  detapd.CompileDistClass( table )
+  dists= []
+  for base in Segments( path, t0, t1 ):
+    for (last,dist) in ReadSegment( base, t0, t1 ):
+      if hours is None  or  InHours( last, hours ):
+        dists.append( dist )
+
+  cnt= detapd.CountDistances( dists )
+  print( '{:24} {:10d}'.format( 'total_airplane', len(dists) ) )
+  for key in detapd.DistKeys + [detapd.DistUnkn]:
+    print( '{:24} {:10d}'.format( key, cnt[key] ) )
+
+#
+# Function Convert adds the air planes in text log files of detapd.py to the
+# archive in directory path. The lines marking the start of data acquisition
+# are skipped, as well as the distances to additional reference points.
+#
+def Convert( path, logs ):
+  pattern= re.compile( r'^(\S+) (\S+) (\S+) (.{8,}?) +(\d+) +(-?\d+)(?: +-?\d+)*$' )
+  archive= detapd.PlaneArchive( path )
+  count= 0
+  for log in logs:
+    with open( log, 'r', errors='replace' ) as f:
+      for line in f:
+        m= pattern.match( line.rstrip('\n') )
+        if m is None:  continue
+        cs= m.group(4).strip()
+        archive.Append( ParseTime(m.group(1)), ParseTime(m.group(2)), m.group(3),
+                        None if cs == '??' else cs, int(m.group(5)),
+                        float(m.group(6)) )
+        count+= 1
+  archive.Close()
+  print( 'Converted {} air planes'.format(count) )
+
+
+#
+# MAIN PROGRAM.
+# =============
+#
+if __name__ == '__main__':
+  parser= argparse.ArgumentParser( description='Query the archive of passed '
+            'air planes of detapd.py.' )
+  parser.add_argument( '--archive', default=detapd.ArchiveDir, metavar='DIR',
+            help='archive directory, default {}'.format(detapd.ArchiveDir) )
+  sub= parser.add_subparsers( dest='command', required=True )
+
+  q= sub.add_parser( 'query', help='compute a distance distribution' )
+  q.add_argument( '--from', dest='t0', type=ParseTime, default=0,
+            help='start of time range, as YYYY-MM-DD[THH:MM]' )
+  q.add_argument( '--to', dest='t1', type=ParseTime, default=math.inf,
+            help='end of time range (exclusive), as YYYY-MM-DD[THH:MM]' )
+  q.add_argument( '--hours', type=ParseHours,
+            help='time of day range, as HH:MM-HH:MM' )
+  q.add_argument( '--bins', type=ParseBins, default=detapd.DistClass,
+            help='comma-separated class boundaries in [m], default the '
+                 'classes of detapd.py' )
+
+  c= sub.add_parser( 'convert', help='convert text log files to the archive' )
+  c.add_argument( 'logs', nargs='+', metavar='LOG' )
+  args= parser.parse_args()
+
+  if args.command == 'query':
+    Query( args.archive, args.t0, args.t1, args.hours, args.bins )
+  else:
+    Convert( args.archive, args.logs )